@@ -1,3 +1,11 @@
 #!/usr/bin/env python3
-from app import Application
-Application().launch()
\ No newline at end of file
+import importlib
+import sys
+
+if __name__ == '__main__':
+    if sys.argv[1:2] in (['simulate'], ['benchmark']):
+        # Headless runs must not import tkinter, which the GUI needs
+        sys.exit(importlib.import_module(sys.argv[1]).main(sys.argv[2:]))
+
+    from app import Application
+    Application().launch()
\ No newline at end of file
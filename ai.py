@@ -3,21 +3,25 @@ from threading import Thread
 from abc import ABC, abstractmethod
 from random import choice
 
+import numpy as np
+
 from game import Move, GameState
-from messaging import QueueHandler
 
 class BaseAI(ABC):
 
     def __init__(self, game: GameState):
         self.game_state = game
+        self.successors = {} # maps moves to the next state of `self.game_state` while it stays in the state `self.successors_key`
+        self.successors_key = None
 
     def make_move(self, move: Move=None) -> Move:
         """Update the game state by applying `move` or picking the best valid move as determined by `self.evaluate_move`. Returns the move made."""
         if move is None:
             # Generate a list of the highest-evaluated moves
-            best_evaluation, best_moves = None, []            
+            best_evaluation, best_moves = None, []
+            valid_moves = self.game_state.valid_moves()
             for move in Move:
-                if not self.game_state.valid_move(move):
+                if not valid_moves & (1 << move.value):
                     continue
 
                 evaluation = self.evaluate_move(move)
@@ -30,9 +34,26 @@ class BaseAI(ABC):
             # Deterministically pick a highest-evaluated move
             move = best_moves[0]
 
-        self.game_state.update_state(move)
+        self.apply_move(move)
         return move
 
+    def next_state(self, move: Move) -> GameState:
+        """Return the state reached by applying `move` to the game state, which is computed once per state of the game.
+        The game may be changed by others, such as the player in the GUI, so the memo is checked against the game state on every call."""
+        key = (self.game_state.matrix.tobytes(), self.game_state.score, self.game_state.random_state, self.game_state.spawn_4_chance)
+        if key != self.successors_key:
+            self.successors.clear()
+            self.successors_key = key
+        state = self.successors.get(move)
+        if state is None:
+            state = self.successors[move] = self.game_state.next_state(move)
+        return state
+
+    def apply_move(self, move: Move):
+        """Update the game state by applying `move`."""
+        self.game_state.copy_state(self.next_state(move))
+        self.successors.clear()
+
     @abstractmethod
     def evaluate_move(self, move: Move) -> int:
         """Return a value representing the AI's evaluation of applying `move` to the current game state."""
@@ -46,11 +67,7 @@ class BaseAI(ABC):
 class DummyAI(BaseAI):
 
     def evaluate_move(self, move) -> int:
-        val = 0
-        for tile in self.game_state.next_state(move).get_matrix().flatten():
-            if tile != 0:
-                val += tile ** 2
-        return val
+        return int(np.square(self.next_state(move).get_matrix(), dtype=np.int64).sum())
 
     def __str__(self):
         return 'dummy 1'
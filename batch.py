@@ -0,0 +1,213 @@
+"""
+This module implements `BatchGameState`, which holds many games and steps all of them at once using a handful of numpy calls instead of a Python loop per board.
+
+4x4 games are stored as a numpy.ndarray of packed bitboards (see the `bitboard` module) and slide using its lookup tables. Games of any other size are stored as an `(n, size, size)` numpy.ndarray of tile exponents and slide one column at a time across every row of every board.
+"""
+
+import numpy as np
+
+import bitboard
+from game import Move
+
+class BatchGameState(object):
+
+    def __init__(self, n: int=1, size: int=4, seed=None):
+        """Start `n` new games on boards of the given size. `seed` seeds the random number generator used to spawn tiles."""
+        assert size != 0, 'size cannot be 0'
+        self.size = size
+        self.spawn_4_chance = 0.1
+        self.random = np.random.default_rng(seed)
+        self.scores = np.zeros(n, dtype=np.uint64)
+
+        if self.is_packed():
+            self.boards = np.zeros(n, dtype=np.uint64)
+        else:
+            self.boards = np.zeros((n, size, size), dtype=np.uint8)
+
+        self.spawn_tiles()
+
+    @classmethod
+    def from_states(cls, states: list, seed=None):
+        """Return a batch holding a copy of each `GameState` in `states`. All states must have the same size.
+        On 4x4 boards, tiles above 32768 are stored as 32768, as `bitboard.pack` does with `saturate` set, since a nibble cannot hold them."""
+        batch = cls(0, states[0].get_size(), seed)
+        matrices = np.asarray([state.get_matrix() for state in states], dtype=np.uint64)
+        exponents = np.zeros(matrices.shape, dtype=np.uint8)
+        exponents[matrices > 0] = np.log2(matrices[matrices > 0]).astype(np.uint8)
+
+        if batch.is_packed():
+            batch.boards = bitboard.pack_array(np.minimum(exponents, bitboard.MAX_EXPONENT).reshape(len(states), -1))
+        else:
+            batch.boards = exponents
+        batch.scores = np.asarray([state.get_score() for state in states], dtype=np.uint64)
+        batch.spawn_4_chance = states[0].spawn_4_chance
+        return batch
+
+    @classmethod
+    def from_boards(cls, boards: np.ndarray, scores: np.ndarray, spawn_4_chance: float=0.1, seed=None):
+        """Return a batch of 4x4 games holding a copy of the bitboards `boards` with the given `scores`."""
+        batch = cls(0, bitboard.SIZE, seed)
+        batch.boards = np.array(boards, dtype=np.uint64)
+        batch.scores = np.array(scores, dtype=np.uint64)
+        batch.spawn_4_chance = spawn_4_chance
+        return batch
+
+    def copy(self, indices=None):
+        """Return a copy of this batch, optionally keeping only the games selected by `indices`."""
+        batch = BatchGameState(0, self.size)
+        batch.spawn_4_chance = self.spawn_4_chance
+        batch.random = np.random.default_rng(self.random.integers(1 << 63))
+        batch.boards = self.boards.copy() if indices is None else self.boards[indices]
+        batch.scores = self.scores.copy() if indices is None else self.scores[indices]
+        return batch
+
+    def is_packed(self) -> bool:
+        """Return whether the boards are stored as packed bitboards."""
+        return self.size == bitboard.SIZE
+
+    def get_size(self) -> int:
+        return self.size
+
+    def get_scores(self) -> np.ndarray:
+        return self.scores
+
+    def get_matrices(self) -> np.ndarray:
+        """Return the tiles of every board as an `(n, size, size)` numpy.ndarray."""
+        exponents = self._get_cells().reshape(len(self), self.size, self.size)
+        return np.where(exponents > 0, np.left_shift(1, exponents, dtype=np.uint32), 0).astype(np.uint32)
+
+    def slide_tiles(self, moves) -> tuple:
+        """Translate and combine the tiles of each board in the direction given by the `Move.value` in `moves` and return the tuple `(boards, points)`."""
+        moves = np.broadcast_to(np.asarray(moves), len(self))
+        if self.is_packed():
+            return bitboard.slide_array(self.boards, moves)
+        return _slide_grids(self.boards, moves)
+
+    def valid_moves(self) -> np.ndarray:
+        """Return an `(n, 4)` boolean numpy.ndarray whose column `move.value` tells whether `move` slides any tiles of each board."""
+        if self.is_packed():
+            masks = bitboard.valid_moves_array(self.boards)
+            return (masks[:, None] >> np.arange(len(Move), dtype=np.uint8)) & 1 == 1
+
+        valid = np.zeros((len(self), len(Move)), dtype=bool)
+        for move in Move:
+            boards, _ = self.slide_tiles(move.value)
+            valid[:, move.value] = self._changed(boards)
+        return valid
+
+    def game_over(self) -> np.ndarray:
+        """Return a boolean numpy.ndarray that is `True` only for the games that have no more valid moves remaining."""
+        return ~self.valid_moves().any(axis=1)
+
+    def update_state(self, moves) -> np.ndarray:
+        """Apply `moves` to every board and spawn a tile on each board that changed. Return the boolean numpy.ndarray of boards that changed."""
+        boards, points = self.slide_tiles(moves)
+        changed = self._changed(boards)
+
+        self.boards = boards
+        self.scores += points.astype(np.uint64)
+        self.spawn_tiles(changed)
+        return changed
+
+    def afterstates(self, moves):
+        """Return a new batch holding every board right after applying `moves`, before new tiles spawn."""
+        batch = self.copy()
+        batch.boards, points = self.slide_tiles(moves)
+        batch.scores += points.astype(np.uint64)
+        return batch
+
+    def spawn_outcomes(self) -> tuple:
+        """Return the tuple `(parents, batch, probabilities)` holding every tile that can spawn on every board, where `parents` holds the index of the board each outcome spawned on.
+        The probabilities of the outcomes of each board sum to 1."""
+        if self.is_packed():
+            parents, boards, probabilities = bitboard.spawn_outcomes_array(self.boards, self.spawn_4_chance)
+        else:
+            cells = self._get_cells()
+            clear = cells == 0
+            parents, positions = np.nonzero(clear)
+            probabilities = 1 / clear.sum(axis=1)[parents]
+
+            twos, fours = cells[parents], cells[parents]
+            twos[np.arange(len(parents)), positions] = 1
+            fours[np.arange(len(parents)), positions] = 2
+
+            boards = np.concatenate([twos, fours]).reshape(-1, self.size, self.size)
+            parents = np.concatenate([parents, parents])
+            probabilities = np.concatenate([probabilities * (1 - self.spawn_4_chance), probabilities * self.spawn_4_chance])
+
+        batch = self.copy(parents)
+        batch.boards = boards
+        return parents, batch, probabilities
+
+    def spawn_tiles(self, mask=None):
+        """Spawn a tile on a random empty cell of every board selected by the boolean `mask`, or of every board if omitted."""
+        cells = self._get_cells()
+        empty = cells == 0
+        counts = empty.sum(axis=1)
+        mask = counts > 0 if mask is None else mask & (counts > 0)
+
+        # Pick the k-th empty cell of each board with k uniformly distributed
+        picks = (self.random.random(len(self)) * counts).astype(np.int64)
+        positions = np.argmax(np.cumsum(empty, axis=1) > picks[:, None], axis=1)
+        values = np.where(self.random.random(len(self)) < self.spawn_4_chance, 2, 1)
+
+        if self.is_packed():
+            spawned = self.boards | (values.astype(np.uint64) << (4 * positions).astype(np.uint64))
+            self.boards = np.where(mask, spawned, self.boards)
+        else:
+            games = np.flatnonzero(mask)
+            cells[games, positions[games]] = values[games]
+            self.boards = cells.reshape(self.boards.shape)
+
+    def _changed(self, boards: np.ndarray) -> np.ndarray:
+        if self.is_packed():
+            return boards != self.boards
+        return (boards != self.boards).any(axis=(1, 2))
+
+    def _get_cells(self) -> np.ndarray:
+        """Return a new `(n, size*size)` numpy.ndarray holding the tile exponents of every board."""
+        if self.is_packed():
+            return bitboard.unpack_array(self.boards)
+        return self.boards.reshape(len(self), self.size * self.size).copy()
+
+    def __len__(self):
+        return len(self.boards)
+
+    def __str__(self):
+        return str(self.get_matrices())
+
+def _compact_rows(rows: np.ndarray) -> np.ndarray:
+    """Move the tiles of every row to the LEFT while keeping their order."""
+    order = np.argsort(rows == 0, axis=1, kind='stable')
+    return np.take_along_axis(rows, order, axis=1)
+
+def _slide_rows(rows: np.ndarray) -> tuple:
+    """Slide an `(m, size)` numpy.ndarray of tile exponents to the LEFT and return the tuple `(rows, points)`."""
+    rows = _compact_rows(rows)
+    points = np.zeros(len(rows), dtype=np.uint64)
+
+    # A merged tile leaves a zero behind it, so it can never merge a second time
+    for i in range(rows.shape[1] - 1):
+        merge = (rows[:, i] == rows[:, i+1]) & (rows[:, i] != 0)
+        rows[merge, i] += 1
+        rows[merge, i+1] = 0
+        points[merge] += np.left_shift(1, rows[merge, i], dtype=np.uint64)
+
+    return _compact_rows(rows), points
+
+def _slide_grids(grids: np.ndarray, moves: np.ndarray) -> tuple:
+    """Slide an `(n, size, size)` numpy.ndarray of tile exponents and return the tuple `(grids, points)`."""
+    n, size = len(grids), grids.shape[-1]
+    result, points = grids.copy(), np.zeros(n, dtype=np.uint64)
+
+    for move in Move:
+        games = np.flatnonzero(moves == move.value)
+        if games.size == 0:
+            continue
+
+        rotated = np.rot90(grids[games], -move.value, axes=(1, 2))
+        rows, row_points = _slide_rows(rotated.reshape(-1, size))
+        result[games] = np.rot90(rows.reshape(rotated.shape), move.value, axes=(1, 2))
+        points[games] = row_points.reshape(games.size, size).sum(axis=1)
+
+    return result, points
@@ -0,0 +1,91 @@
+import numpy as np
+
+import bitboard
+import heuristics
+from ai import BaseAI
+from game import Move, GameState
+
+MOVES = np.arange(len(Move), dtype=np.int8)
+
+class BeamSearchAI(BaseAI):
+    """Searches `depth` moves ahead from each valid move, keeping only the `width` most promising boards at every ply, so the cost of a move is proportional to `width * depth` however many moves and spawns each board has.
+    Spawns are either sampled at random or taken in expectation:
+    - sampled: the boards of the beam are repeated to fill it, a tile is spawned at random on each, and the `width` best boards under the heuristic are kept among all their valid moves
+    - expected: every tile that can spawn is an outcome weighted by its probability, the `width` most likely outcomes are kept and each makes its best move under the heuristic
+    A move is worth the mean heuristic value of the boards left in its beam, weighted by probability, where the games lost along the way count as `GAME_OVER_VALUE`.
+    Works on 4x4 games only, since the search runs on bitboards (see the `bitboard` module)."""
+
+    GAME_OVER_VALUE = 0
+    SPAWN_MODES = ('sampled', 'expected')
+
+    def __init__(self, game: GameState, width: int=64, depth: int=4, spawns: str='sampled', seed=None):
+        """`width` is the number of boards kept per ply and `depth` is the number of moves searched ahead, including the move evaluated.
+        `spawns` is one of `SPAWN_MODES`, and `seed` seeds the random number generator used to sample spawns."""
+        assert game.get_size() == bitboard.SIZE, f'size must be {bitboard.SIZE}'
+        assert width > 0 and depth > 0, 'width and depth must be positive'
+        assert spawns in BeamSearchAI.SPAWN_MODES, f'spawns must be one of {BeamSearchAI.SPAWN_MODES}'
+        BaseAI.__init__(self, game)
+
+        self.width = width
+        self.depth = depth
+        self.spawns = spawns
+        self.random = np.random.default_rng(seed)
+
+    def evaluate_move(self, move: Move) -> float:
+        """Return the value of the beam grown from applying `move`, or `None` if `move` is not valid."""
+        board = bitboard.pack(self.game_state.get_matrix(), saturate=True)
+        afterstate, _ = bitboard.slide(board, move.value)
+        if afterstate == board:
+            return None
+
+        # The beam holds afterstates, which are the boards left by a move before a tile spawns
+        boards, weights, lost = np.asarray([afterstate], dtype=np.uint64), np.ones(1), 0.0
+        for _ in range(self.depth - 1):
+            boards, weights = self.spawn(boards, weights)
+            boards, weights, dead = self.step(boards, weights)
+            lost += dead
+            if len(boards) == 0:
+                return self.GAME_OVER_VALUE
+
+        values = heuristics.evaluate_array(boards)
+        return float((weights * values).sum() / (weights.sum() + lost))
+
+    def spawn(self, boards: np.ndarray, weights: np.ndarray) -> tuple:
+        """Return the tuple `(boards, weights)` of the boards of the beam after a tile spawns on the afterstates `boards`."""
+        if self.spawns == 'expected':
+            parents, outcomes, probabilities = bitboard.spawn_outcomes_array(boards, self.game_state.spawn_4_chance)
+            weights = weights[parents] * probabilities
+            kept = _top(weights, self.width)
+            return outcomes[kept], weights[kept]
+
+        # Split the beam between copies of each board so that every ply samples `width` spawns
+        copies = max(1, self.width // len(boards))
+        boards, weights = np.repeat(boards, copies), np.repeat(weights / copies, copies)
+        random_states = self.random.integers(1 << 63, size=len(boards), dtype=np.uint64)
+        boards, _ = bitboard.spawn_array(boards, random_states, self.game_state.spawn_4_chance)
+        return boards, weights
+
+    def step(self, boards: np.ndarray, weights: np.ndarray) -> tuple:
+        """Apply the moves searched on `boards` and return the tuple `(afterstates, weights, lost)`, where `lost` is the total weight of the boards with no valid move."""
+        afterstates, _ = bitboard.slide_array(boards[:, None], MOVES[None, :])
+        valid = afterstates != boards[:, None]
+        values = np.where(valid, heuristics.evaluate_array(afterstates), -np.inf)
+        alive = valid.any(axis=1)
+        lost = float(weights[~alive].sum())
+
+        if self.spawns == 'expected':
+            best = np.argmax(values[alive], axis=1)
+            return afterstates[alive, best], weights[alive], lost
+
+        owners, moves = np.nonzero(valid)
+        kept = _top(values[owners, moves], self.width)
+        return afterstates[owners[kept], moves[kept]], weights[owners[kept]], lost
+
+    def __str__(self) -> str:
+        return f'Beam Search (width {self.width}, depth {self.depth}, {self.spawns} spawns)'
+
+def _top(values: np.ndarray, k: int) -> np.ndarray:
+    """Return the indices of the `k` largest values, or of every value if there are at most `k`."""
+    if len(values) <= k:
+        return np.arange(len(values))
+    return np.argpartition(values, len(values) - k)[len(values) - k:]
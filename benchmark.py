@@ -0,0 +1,272 @@
+"""
+This module is a reproducible benchmark suite, which writes its results as JSON and compares them against a stored baseline.
+
+Every benchmark measures a rate, so higher is always better:
+- micro benchmarks time single `GameState` operations over a fixed set of mid-game states
+- macro benchmarks time the growth of a `GameTree`, the moves made per second by each AI and the throughput of whole games
+
+Each benchmark keeps its best rate over `--rounds` timed rounds after a warmup round, in each of `--repeat` passes over the suites.
+
+Every state, game and AI is seeded, so each run does the same work. Run it through the package entry point, for example:
+
+    python . benchmark --output results.json
+    python . benchmark --update-baseline --repeat 5 --tolerance 0.4
+
+The exit status is 1 if any benchmark is more than `--tolerance` slower than the baseline. The baseline stores the passes, rounds and tolerance it was recorded with, which a comparison uses unless given others, so that both sides keep the best of as many measurements.
+Rates depend on the machine, so the baseline should be recorded on the machine that runs the comparison.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from beam_search_ai import BeamSearchAI
+from expectimax_ai import ExpectimaxAI
+from game import Move, GameState
+from mcts_ai import MCTSAI
+from monte_carlo_ai import MonteCarloAI
+from simulate import run_games
+from tree_ai import GameTree
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+Result = namedtuple('Result', ['name', 'value', 'unit'])
+Comparison = namedtuple('Comparison', ['name', 'value', 'baseline', 'ratio', 'regressed'])
+
+SEED = 2048
+WARMUP = 1 # rounds run before timing
+ROUNDS = 3 # timed rounds, of which the fastest is kept
+REPEAT = 1 # passes over the suites
+TOLERANCE = 0.25
+MIN_TIME = 0.1 # seconds taken by each round of a micro benchmark, so that timer resolution and short stalls do not matter
+
+def sample_states(size: int=4, n: int=64, seed: int=SEED) -> list:
+    """Return `n` mid-game states with at least one empty tile, reached by playing seeded random moves."""
+    rng, states = random.Random(seed), []
+    while len(states) < n:
+        state = GameState(size, rng.getrandbits(32))
+        for _ in range(rng.randrange(10, 100)):
+            moves = [move for move in Move if state.valid_move(move)]
+            if not moves:
+                break
+            state.update_state(rng.choice(moves))
+        if (state.get_matrix() == 0).any():
+            states.append(state)
+    return states
+
+def timed(function, rounds: int=ROUNDS, warmup: int=WARMUP, setup=None) -> float:
+    """Return the fastest time in seconds of `rounds` calls to `function` after `warmup` untimed calls.
+    If given, `setup` is called before each call and its result is passed to `function` without being timed."""
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(warmup + rounds):
+            args = () if setup is None else (setup(),)
+            start = time.perf_counter()
+            function(*args)
+            elapsed = time.perf_counter() - start
+            if i >= warmup and (best is None or elapsed < best):
+                best = elapsed
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+def calibrate(function, min_time: float=MIN_TIME) -> int:
+    """Return the number of calls to `function` that take at least `min_time` seconds, doubling from 1."""
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        if time.perf_counter() - start >= min_time:
+            return calls
+        calls *= 2
+
+def micro_benchmarks(size: int, rounds: int=ROUNDS) -> list:
+    """Return the rates of the single `GameState` operations on `size`x`size` boards, in calls per second."""
+    states = sample_states(size)
+    moves = list(Move)
+    operations = {
+        'slide_tiles': lambda: [state.slide_tiles(move) for state in states for move in moves],
+        'next_state': lambda: [state.next_state(move) for state in states for move in moves],
+        'valid_move': lambda: [state.valid_move(move) for state in states for move in moves],
+        'game_over': lambda: [state.game_over() for state in states for _ in moves],
+    }
+
+    results = []
+    for name, function in operations.items():
+        loops = calibrate(function)
+        elapsed = timed(lambda: [function() for _ in range(loops)], rounds)
+        results.append(Result(f'{name}[{size}x{size}]', loops * len(states) * len(moves) / elapsed, 'calls/s'))
+
+    # Spawning changes the state, so every round spawns on fresh copies
+    spawn = lambda copies: [state.spawn_tile() for state in copies]
+    loops = calibrate(lambda: spawn([state.copy() for state in states]))
+    elapsed = timed(spawn, rounds, setup=lambda: [state.copy() for _ in range(loops) for state in states])
+    results.append(Result(f'spawn_tile[{size}x{size}]', loops * len(states) / elapsed, 'calls/s'))
+    return results
+
+def tree_growth(chance_nodes: bool, nodes: int=20000, rounds: int=ROUNDS) -> Result:
+    """Return the rate at which a `GameTree` grows to `nodes` nodes, in nodes per second.
+    The tree is grown on the calling thread rather than its own, so no time is lost waiting for it."""
+    def grow(tree: GameTree):
+        with tree.lock:
+            while len(tree.pool) < nodes:
+                tree.grow()
+
+    trees = []
+    def setup() -> GameTree:
+        tree = GameTree(GameState(seed=SEED), chance_nodes=chance_nodes, target_size=1) # the tree's own thread never grows it
+        trees.append(tree)
+        return tree
+
+    elapsed = timed(grow, rounds, setup=setup)
+    sizes = [len(tree.pool) for tree in trees]
+    for tree in trees:
+        tree.kill_thread()
+    return Result(f'tree_growth[{"chance" if chance_nodes else "sampled"}]', min(sizes) / elapsed, 'nodes/s')
+
+AI_BENCHMARKS = {
+    'expectimax': (lambda game: ExpectimaxAI(game, depth=2), 20),
+    'beam': (lambda game: BeamSearchAI(game, width=64, depth=4, seed=SEED), 20),
+    'montecarlo': (lambda game: MonteCarloAI(game, playouts=20, seed=SEED), 10),
+    'mcts': (lambda game: MCTSAI(game, iterations=64, seed=SEED), 10),
+}
+
+def moves_per_second(name: str, rounds: int=ROUNDS) -> Result:
+    """Return the rate at which the AI named `name` in `AI_BENCHMARKS` makes the first moves of a seeded game, in moves per second.
+    Each round starts a new game and a new AI, so caches kept across moves start empty."""
+    make_ai, moves = AI_BENCHMARKS[name]
+    def play(ai):
+        for _ in range(moves):
+            ai.make_move()
+
+    elapsed = timed(play, rounds, setup=lambda: make_ai(GameState(seed=SEED)))
+    return Result(f'moves[{name}]', moves / elapsed, 'moves/s')
+
+def game_throughput(games: int=20, rounds: int=ROUNDS) -> list:
+    """Return the rates at which the dummy AI plays whole seeded games on a single process, in games and moves per second."""
+    rows = []
+    elapsed = timed(lambda: rows.append(list(run_games('dummy', {}, games, SEED, workers=1))), rounds)
+    moves = sum(row['moves'] for row in rows[-1])
+    return [Result('games[dummy]', games / elapsed, 'games/s'), Result('game_moves[dummy]', moves / elapsed, 'moves/s')]
+
+SUITES = { # each suite is called with the number of timed rounds
+    'micro': lambda rounds: micro_benchmarks(4, rounds) + micro_benchmarks(5, rounds),
+    'tree_growth': lambda rounds: [tree_growth(False, rounds=rounds), tree_growth(True, rounds=rounds)],
+    'moves': lambda rounds: [moves_per_second(name, rounds) for name in AI_BENCHMARKS],
+    'games': lambda rounds: game_throughput(rounds=rounds),
+}
+
+def run_benchmarks(suites: list=None, repeat: int=REPEAT, rounds: int=ROUNDS) -> list:
+    """Run the benchmarks of every suite named in `suites`, or of every suite in `SUITES`, `repeat` times with `rounds` timed rounds each and return the best result of each.
+    Repeating the whole suite rather than each benchmark spreads the runs of a benchmark over time, past slow spells of a shared machine."""
+    best = {}
+    for _ in range(repeat):
+        for name, run in SUITES.items():
+            if suites is None or name in suites:
+                for result in run(rounds):
+                    if result.name not in best or result.value > best[result.name].value:
+                        best[result.name] = result
+    return list(best.values())
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compare the rates in `results` with those in `baseline`, both dicts mapping names to rates, and return a `Comparison` for each benchmark in both.
+    A benchmark has regressed if its rate fell by more than the fraction `tolerance` of its baseline."""
+    return [Comparison(name, value, baseline[name], value / baseline[name], value < (1 - tolerance) * baseline[name])
+        for name, value in results.items() if name in baseline]
+
+def to_json(results: list, repeat: int=REPEAT, rounds: int=ROUNDS, tolerance: float=TOLERANCE) -> dict:
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'seed': SEED,
+        'repeat': repeat,
+        'rounds': rounds,
+        'tolerance': tolerance,
+        'results': {result.name: {'value': result.value, 'unit': result.unit} for result in results},
+    }
+
+def write_json(data: dict, path: str):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+
+def load_json(path: str) -> dict:
+    """Return the results file at `path`, or `None` if there is none."""
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def get_rates(data: dict) -> dict:
+    """Return a dict mapping the name of each benchmark in the results `data` to its rate."""
+    return {name: result['value'] for name, result in data['results'].items()}
+
+def parse_args(argv: list=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='benchmark', description='Run the benchmark suite and compare it against a baseline.')
+    parser.add_argument('-s', '--suite', action='append', choices=list(SUITES), help='suite to run; may be repeated (default: every suite)')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='results to compare against (default: %(default)s)')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results to the baseline instead of comparing against it')
+    parser.add_argument('-r', '--repeat', type=int, help=f'number of passes over the suites, keeping the best rate of each benchmark (default: that of the baseline, else {REPEAT})')
+    parser.add_argument('--rounds', type=int, help=f'number of timed rounds of each benchmark in each pass (default: that of the baseline, else {ROUNDS})')
+    parser.add_argument('--tolerance', type=float, help=f'fraction by which a rate may fall before it counts as a regression (default: that of the baseline, else {TOLERANCE})')
+    args = parser.parse_args(argv)
+    if (args.repeat is not None and args.repeat < 1) or (args.rounds is not None and args.rounds < 1):
+        parser.error('repeat and rounds must be positive')
+    return args
+
+def main(argv: list=None) -> int:
+    args = parse_args(argv)
+    baseline = load_json(args.baseline)
+
+    # Unless given, measure as the baseline was measured, so that both keep the best of as many rounds
+    recorded = baseline if baseline is not None and not args.update_baseline else {}
+    repeat = args.repeat if args.repeat is not None else recorded.get('repeat', REPEAT)
+    rounds = args.rounds if args.rounds is not None else recorded.get('rounds', ROUNDS)
+    tolerance = args.tolerance if args.tolerance is not None else recorded.get('tolerance', TOLERANCE)
+
+    results = run_benchmarks(args.suite, repeat, rounds)
+    data = to_json(results, repeat, rounds, tolerance)
+    if args.output is not None:
+        write_json(data, args.output)
+
+    if args.update_baseline:
+        # Benchmarks of the suites that were not run keep their baseline
+        if args.suite is not None and baseline is not None:
+            data['results'] = dict(baseline['results'], **data['results'])
+        write_json(data, args.baseline)
+
+    if args.update_baseline or baseline is None:
+        for result in results:
+            print(f'{result.name:<28} {result.value:>14,.1f} {result.unit}')
+        if baseline is None:
+            print(f'No baseline found at {args.baseline}', file=sys.stderr)
+        return 0
+
+    comparisons = compare({result.name: result.value for result in results}, get_rates(baseline), tolerance)
+    units = {result.name: result.unit for result in results}
+    for comparison in comparisons:
+        flag = '  REGRESSION' if comparison.regressed else ''
+        print(f'{comparison.name:<28} {comparison.value:>14,.1f} {units[comparison.name]:<8} {comparison.ratio:>6.2f}x baseline{flag}')
+
+    regressions = [comparison.name for comparison in comparisons if comparison.regressed]
+    if regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}', file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""
+This module implements a bitboard engine for the standard 4x4 game.
+
+A board is stored as a single 64-bit integer where every 4-bit nibble holds the log2 exponent of a tile (0 for an empty tile). The tile at `(row, col)` lives in nibble `4*row + col`, so each row occupies 16 consecutive bits. Every possible row is precomputed into 65,536-entry lookup tables, which makes a LEFT or RIGHT move four table lookups. UP and DOWN moves transpose the board, slide the rows and transpose back.
+
+Moves are identified by their `Move.value`, so this module can be used without importing `game`. Nibbles saturate at 15 (a tile of 32768), and two such tiles never merge.
+"""
+
+import numpy as np
+
+import prng
+
+SIZE = 4
+MAX_EXPONENT = 15
+
+ROW_MASK = 0xFFFF
+COL_MASK = 0x000F000F000F000F
+
+LEFT, DOWN, RIGHT, UP = 0, 1, 2, 3  # `Move.value` of each direction
+
+def _reverse_row(row: int) -> int:
+    return ((row & 0xF) << 12) | ((row & 0xF0) << 4) | ((row >> 4) & 0xF0) | (row >> 12)
+
+def _slide_row_left(row: int) -> tuple:
+    """Return the tuple `(row, points)` produced by sliding the packed `row` to the LEFT."""
+    tiles = [(row >> (4*i)) & 0xF for i in range(SIZE)]
+    tiles = [tile for tile in tiles if tile != 0]
+    merged, points, i = [], 0, 0
+
+    while i < len(tiles):
+        if i+1 < len(tiles) and tiles[i] == tiles[i+1] and tiles[i] != MAX_EXPONENT:
+            merged.append(tiles[i] + 1)
+            points += 1 << (tiles[i] + 1)
+            i += 2
+        else:
+            merged.append(tiles[i])
+            i += 1
+
+    result = 0
+    for i, tile in enumerate(merged):
+        result |= tile << (4*i)
+    return result, points
+
+def _build_tables() -> tuple:
+    left, right, score = [0] * (1 << 16), [0] * (1 << 16), [0] * (1 << 16)
+    for row in range(1 << 16):
+        left[row], score[row] = _slide_row_left(row)
+    for row in range(1 << 16):
+        right[row] = _reverse_row(left[_reverse_row(row)])
+    return left, right, score
+
+# Plain lists are used for scalar lookups since indexing them is much faster than indexing a numpy.ndarray
+ROW_LEFT, ROW_RIGHT, ROW_SCORE = _build_tables()
+ROW_SCORE_RIGHT = [ROW_SCORE[_reverse_row(row)] for row in range(1 << 16)]
+
+# numpy.ndarray copies of the tables for vectorized lookups
+ROW_LEFT_TABLE = np.asarray(ROW_LEFT, dtype=np.uint64)
+ROW_RIGHT_TABLE = np.asarray(ROW_RIGHT, dtype=np.uint64)
+ROW_SCORE_TABLE = np.asarray(ROW_SCORE, dtype=np.uint64)
+ROW_SCORE_RIGHT_TABLE = np.asarray(ROW_SCORE_RIGHT, dtype=np.uint64)
+
+EXPONENTS = {1 << e: e for e in range(1, MAX_EXPONENT)}
+EXPONENTS[0] = 0
+TILES = [0] + [1 << e for e in range(1, MAX_EXPONENT+1)]
+
+def pack(matrix, saturate: bool=False) -> int:
+    """Return the bitboard of a 4x4 `matrix` of tile values.
+    Raise a `KeyError` if the matrix holds a tile that is not a power of two below 32768, since such a board might not slide correctly on the bitboard.
+    If `saturate` is set, such tiles are stored as 15 (a tile of 32768) instead, which is close enough for a search to rank boards."""
+    board = 0
+    for i, tile in enumerate(np.asarray(matrix).ravel().tolist()):
+        board |= (EXPONENTS.get(tile, MAX_EXPONENT) if saturate else EXPONENTS[tile]) << (4*i)
+    return board
+
+def unpack(board: int) -> np.ndarray:
+    """Return the 4x4 matrix of tile values represented by `board`."""
+    return np.asarray([TILES[(board >> (4*i)) & 0xF] for i in range(SIZE*SIZE)], dtype=np.uint32).reshape(SIZE, SIZE)
+
+def get_tile(board: int, row: int, col: int) -> int:
+    """Return the exponent of the tile at the specified position."""
+    return (board >> (4 * (SIZE*row + col))) & 0xF
+
+def count_empty(board: int) -> int:
+    """Return the number of empty tiles on `board`."""
+    board |= (board >> 2) & 0x3333333333333333
+    board |= board >> 1
+    return bin(~board & 0x1111111111111111).count('1')
+
+def empty_shifts(board: int) -> list:
+    """Return the bit offsets of the empty tiles on `board`."""
+    return [shift for shift in range(0, 64, 4) if not (board >> shift) & 0xF]
+
+def transpose(board: int) -> int:
+    """Return `board` reflected along its main diagonal."""
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+def _slide_rows(board: int, table: list, scores: list) -> tuple:
+    r0, r1, r2, r3 = board & ROW_MASK, (board >> 16) & ROW_MASK, (board >> 32) & ROW_MASK, board >> 48
+    result = table[r0] | (table[r1] << 16) | (table[r2] << 32) | (table[r3] << 48)
+    return result, scores[r0] + scores[r1] + scores[r2] + scores[r3]
+
+def slide_left(board: int) -> tuple:
+    return _slide_rows(board, ROW_LEFT, ROW_SCORE)
+
+def slide_right(board: int) -> tuple:
+    return _slide_rows(board, ROW_RIGHT, ROW_SCORE_RIGHT)
+
+def slide_up(board: int) -> tuple:
+    result, points = _slide_rows(transpose(board), ROW_LEFT, ROW_SCORE)
+    return transpose(result), points
+
+def slide_down(board: int) -> tuple:
+    result, points = _slide_rows(transpose(board), ROW_RIGHT, ROW_SCORE_RIGHT)
+    return transpose(result), points
+
+SLIDES = (slide_left, slide_down, slide_right, slide_up) # indexed by `Move.value`
+
+def slide(board: int, move: int) -> tuple:
+    """Translate and combine tiles in the direction given by the `Move.value` of `move` and return the tuple `(board, points)`."""
+    return SLIDES[move](board)
+
+# Bitmask of the moves that slide any tiles of a row, with bit `1 << move.value` set for each valid move
+ROW_MOVES = [(row != ROW_LEFT[row]) << LEFT | (row != ROW_RIGHT[row]) << RIGHT for row in range(1 << 16)]
+COL_MOVES = [(row != ROW_LEFT[row]) << UP | (row != ROW_RIGHT[row]) << DOWN for row in range(1 << 16)]
+
+ROW_MOVES_TABLE = np.asarray(ROW_MOVES, dtype=np.uint8)
+COL_MOVES_TABLE = np.asarray(COL_MOVES, dtype=np.uint8)
+
+def valid_moves(board: int) -> int:
+    """Return the bitmask of valid moves, where bit `1 << move.value` is set if `move` slides any tiles."""
+    cols = transpose(board)
+    return ROW_MOVES[board & ROW_MASK] | ROW_MOVES[(board >> 16) & ROW_MASK] | \
+        ROW_MOVES[(board >> 32) & ROW_MASK] | ROW_MOVES[board >> 48] | \
+        COL_MOVES[cols & ROW_MASK] | COL_MOVES[(cols >> 16) & ROW_MASK] | \
+        COL_MOVES[(cols >> 32) & ROW_MASK] | COL_MOVES[cols >> 48]
+
+# The eight symmetries of the board are numbered by the bits `MIRROR | FLIP | TRANSPOSE`, applied in the order TRANSPOSE, MIRROR, FLIP
+MIRROR, FLIP, TRANSPOSE = 1, 2, 4
+SYMMETRIES = range(8)
+
+ROW_REVERSE = [_reverse_row(row) for row in range(1 << 16)]
+
+def mirror(board: int) -> int:
+    """Return `board` reflected from LEFT to RIGHT."""
+    return ROW_REVERSE[board & ROW_MASK] | (ROW_REVERSE[(board >> 16) & ROW_MASK] << 16) | \
+        (ROW_REVERSE[(board >> 32) & ROW_MASK] << 32) | (ROW_REVERSE[board >> 48] << 48)
+
+def flip(board: int) -> int:
+    """Return `board` reflected from UP to DOWN."""
+    return ((board & ROW_MASK) << 48) | (((board >> 16) & ROW_MASK) << 32) | (((board >> 32) & ROW_MASK) << 16) | (board >> 48)
+
+def symmetry(board: int, sym: int) -> int:
+    """Return `board` transformed by the symmetry numbered `sym`."""
+    if sym & TRANSPOSE:
+        board = transpose(board)
+    if sym & MIRROR:
+        board = mirror(board)
+    if sym & FLIP:
+        board = flip(board)
+    return board
+
+def canonical(board: int) -> tuple:
+    """Return the tuple `(board, sym)` where `board` is the smallest of the eight symmetries of `board` and `sym` is the symmetry that produces it.
+    Boards that are rotations or reflections of each other share the same canonical board."""
+    transposed = transpose(board)
+    candidates = [board, mirror(board), 0, 0, transposed, mirror(transposed), 0, 0]
+    for sym in [0, MIRROR, TRANSPOSE, TRANSPOSE | MIRROR]:
+        candidates[sym | FLIP] = flip(candidates[sym])
+
+    best = min(SYMMETRIES, key=candidates.__getitem__)
+    return candidates[best], best
+
+def _transform_moves(sym: int) -> list:
+    moves = list(range(4))
+    if sym & TRANSPOSE:
+        moves = [{LEFT: UP, UP: LEFT, RIGHT: DOWN, DOWN: RIGHT}[move] for move in moves]
+    if sym & MIRROR:
+        moves = [{LEFT: RIGHT, RIGHT: LEFT}.get(move, move) for move in moves]
+    if sym & FLIP:
+        moves = [{UP: DOWN, DOWN: UP}.get(move, move) for move in moves]
+    return moves
+
+SYMMETRY_MOVES = [_transform_moves(sym) for sym in SYMMETRIES]
+INVERSE_SYMMETRY_MOVES = [[moves.index(move) for move in range(4)] for moves in SYMMETRY_MOVES]
+
+def transform_move(move: int, sym: int) -> int:
+    """Return the `Move.value` on a board transformed by `sym` that corresponds to the `Move.value` `move` on the original board."""
+    return SYMMETRY_MOVES[sym][move]
+
+def restore_move(move: int, sym: int) -> int:
+    """Return the `Move.value` on the original board that corresponds to the `Move.value` `move` on the board transformed by `sym`."""
+    return INVERSE_SYMMETRY_MOVES[sym][move]
+
+def spawn_outcomes(board: int, spawn_4_chance: float=0.1) -> list:
+    """Return the list of tuples `(probability, board)` for every tile that can spawn on `board`."""
+    clear_tiles = empty_shifts(board)
+    outcomes = []
+    for shift in clear_tiles:
+        outcomes.append(((1 - spawn_4_chance) / len(clear_tiles), board | (1 << shift)))
+        if spawn_4_chance > 0:
+            outcomes.append((spawn_4_chance / len(clear_tiles), board | (2 << shift)))
+    return outcomes
+
+def valid_move(board: int, move: int) -> bool:
+    """Return whether the move with `Move.value` equal to `move` slides any tiles."""
+    return bool(valid_moves(board) >> move & 1)
+
+# Vectorized variants operating on numpy.ndarray of boards with dtype numpy.uint64
+
+ROW_SHIFTS = np.arange(0, 64, 16, dtype=np.uint64)
+CELL_SHIFTS = np.arange(0, 64, 4, dtype=np.uint64)
+
+def pack_array(cells: np.ndarray) -> np.ndarray:
+    """Return the boards given by the exponents in `cells`, an array whose last axis holds the 16 tiles of each board."""
+    return np.bitwise_or.reduce(cells.astype(np.uint64) << CELL_SHIFTS, axis=-1)
+
+def unpack_array(boards: np.ndarray) -> np.ndarray:
+    """Return the tile exponents of `boards` along a new last axis of length 16."""
+    return ((boards[..., None] >> CELL_SHIFTS) & 0xF).astype(np.uint8)
+
+def slide_array(boards: np.ndarray, moves) -> tuple:
+    """Vectorized `slide`, where `moves` holds the `Move.value` to apply to each board. Return the tuple `(boards, points)`."""
+    boards, moves = np.broadcast_arrays(boards, moves)
+    vertical = (moves == UP) | (moves == DOWN)
+    reverse = (moves == RIGHT) | (moves == DOWN)
+
+    boards = np.where(vertical, transpose(boards), boards)
+    rows = (boards[..., None] >> ROW_SHIFTS) & ROW_MASK
+    result = np.where(reverse[..., None], ROW_RIGHT_TABLE[rows], ROW_LEFT_TABLE[rows])
+    points = np.where(reverse[..., None], ROW_SCORE_RIGHT_TABLE[rows], ROW_SCORE_TABLE[rows]).sum(axis=-1)
+    result = np.bitwise_or.reduce(result << ROW_SHIFTS, axis=-1)
+
+    return np.where(vertical, transpose(result), result), points
+
+def spawn_outcomes_array(boards: np.ndarray, spawn_4_chance: float=0.1) -> tuple:
+    """Vectorized `spawn_outcomes` for a 1-dimensional numpy.ndarray of boards. Return the tuple `(parents, boards, probabilities)`, where `parents` holds the index of the board each outcome spawned on."""
+    clear = unpack_array(boards) == 0
+    parents, positions = np.nonzero(clear)
+    probabilities = 1 / clear.sum(axis=1)[parents]
+    shifts = (4 * positions).astype(np.uint64)
+
+    return np.concatenate([parents, parents]), \
+        np.concatenate([boards[parents] | (np.uint64(1) << shifts), boards[parents] | (np.uint64(2) << shifts)]), \
+        np.concatenate([probabilities * (1 - spawn_4_chance), probabilities * spawn_4_chance])
+
+ROW_REVERSE_TABLE = np.asarray(ROW_REVERSE, dtype=np.uint64)
+
+def canonical_array(boards: np.ndarray) -> tuple:
+    """Vectorized `canonical`, returning the tuple `(boards, syms)` of numpy.ndarray."""
+    candidates = np.empty(boards.shape + (8,), dtype=np.uint64)
+    candidates[..., 0] = boards
+    candidates[..., TRANSPOSE] = transpose(boards)
+    for sym in [0, TRANSPOSE]:
+        rows = (candidates[..., sym, None] >> ROW_SHIFTS) & ROW_MASK
+        candidates[..., sym | MIRROR] = np.bitwise_or.reduce(ROW_REVERSE_TABLE[rows] << ROW_SHIFTS, axis=-1)
+    for sym in [0, MIRROR, TRANSPOSE, TRANSPOSE | MIRROR]:
+        rows = (candidates[..., sym, None] >> ROW_SHIFTS) & ROW_MASK
+        candidates[..., sym | FLIP] = np.bitwise_or.reduce(rows << ROW_SHIFTS[::-1], axis=-1)
+
+    syms = np.argmin(candidates, axis=-1)
+    return np.take_along_axis(candidates, syms[..., None], axis=-1)[..., 0], syms
+
+def spawn_array(boards: np.ndarray, random_states: np.ndarray, spawn_4_chance: float=0.1) -> tuple:
+    """Spawn a tile on every board drawn from the SplitMix64 generator states in `random_states`, exactly as `PackedState.next_state` would. Every board must have an empty tile.
+    Return the tuple `(boards, random_states)`."""
+    clear = unpack_array(boards) == 0
+    random_states, picks = prng.next_below_array(random_states, clear.sum(axis=-1))
+    random_states, chances = prng.next_float_array(random_states)
+
+    positions = np.argmax(np.cumsum(clear, axis=-1) > picks.astype(np.int64)[..., None], axis=-1)
+    tiles = np.where(chances >= spawn_4_chance, 1, 2).astype(np.uint64)
+    return boards | (tiles << (4 * positions).astype(np.uint64)), random_states
+
+def valid_moves_array(boards: np.ndarray) -> np.ndarray:
+    """Vectorized `valid_moves`, returning a numpy.ndarray of bitmasks."""
+    rows = (boards[..., None] >> ROW_SHIFTS) & ROW_MASK
+    cols = (transpose(boards)[..., None] >> ROW_SHIFTS) & ROW_MASK
+    return np.bitwise_or.reduce(ROW_MOVES_TABLE[rows] | COL_MOVES_TABLE[cols], axis=-1)
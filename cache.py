@@ -0,0 +1,75 @@
+"""
+This module implements `EvaluationCache`, a size-bounded cache of search results keyed by a 4x4 bitboard (see the `bitboard` module) and the depth it was searched to.
+
+Entries are kept in least recently used order, so once the cache is full, storing a new entry evicts the entry that went unused the longest. The cache is meant to live as long as the game: positions searched while choosing one move are found again while choosing the next ones.
+"""
+
+from collections import OrderedDict, namedtuple
+
+CacheStats = namedtuple('CacheStats', ['size', 'hits', 'misses', 'evictions'])
+
+class EvaluationCache(object):
+
+    ENTRY_NBYTES = 220 # approximate memory used by an entry, as measured with `tracemalloc`
+
+    def __init__(self, max_entries: int=1 << 20, max_bytes: int=None):
+        """Keep at most `max_entries` entries, and at most as many as fit in `max_bytes` bytes if given."""
+        if max_bytes is not None:
+            max_entries = min(max_entries, max_bytes // EvaluationCache.ENTRY_NBYTES)
+        assert max_entries > 0, 'cache must hold at least one entry'
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # maps (board, depth) to a value, from least to most recently used
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, board: int, depth: int, context=None) -> float:
+        """Return the value stored for `board` searched to `depth`, or `None` if there is none.
+        `context` tells apart values of the same board searched differently, such as under different pruning."""
+        key = (board, depth) if context is None else (board, depth, context)
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def find(self, board: int, depth: int, context=None) -> tuple:
+        """Return the tuple `(value, context)` of the value stored for `board` searched to `depth` without a context, or else under `context`, and the context it was stored under.
+        `value` is `None` if there is neither. A single hit or miss is counted."""
+        key = (board, depth)
+        value = self.entries.get(key)
+        if value is None and context is not None:
+            key = (board, depth, context)
+            value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value, None if len(key) == 2 else context
+
+    def put(self, board: int, depth: int, value: float, context=None):
+        """Store `value` for `board` searched to `depth`, evicting the least recently used entry if the cache is full."""
+        key = (board, depth) if context is None else (board, depth, context)
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+    def clear(self):
+        """Remove every entry. The counters are kept."""
+        self.entries.clear()
+
+    def get_stats(self) -> CacheStats:
+        return CacheStats(len(self.entries), self.hits, self.misses, self.evictions)
+
+    def get_nbytes(self) -> int:
+        """Return the approximate memory used by the entries."""
+        return len(self.entries) * EvaluationCache.ENTRY_NBYTES
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: tuple):
+        return key in self.entries
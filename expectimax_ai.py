@@ -0,0 +1,241 @@
+import math
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import bitboard
+import heuristics
+from ai import BaseAI
+from cache import EvaluationCache
+from game import Move, GameState
+
+SearchStats = namedtuple('SearchStats', ['depth', 'nodes', 'time']) # time is in milliseconds
+
+class SearchTimeout(Exception):
+    pass
+
+class ExpectimaxAI(BaseAI):
+    """Searches every sequence of moves up to `depth` moves ahead, where every tile that can spawn after a move is a chance node weighted by its probability.
+    Unlikely branches can be pruned: a board whose path probability from the root falls below `prob_cutoff` is evaluated by the heuristic instead of being searched, and once `max_fours` 4 tiles spawned along a path only 2 tiles are searched, standing in for both.
+    The transposition table outlives the paths its values were computed on, so values of pruned subtrees are stored apart from exact values, along with the number of 4 tiles left to search and the power of 2 closest to the path probability if `prob_cutoff` is set. They are only reused on paths pruned alike, where they count as a cutoff so that the values of their ancestors are stored apart too.
+    Works on 4x4 games only, since the search runs on bitboards (see the `bitboard` module)."""
+
+    GAME_OVER_VALUE = 0
+    DEADLINE_CHECK_INTERVAL = 256 # number of nodes searched between checks of the deadline
+
+    def __init__(self, game: GameState, depth: int=2, table_size: int=1 << 20, max_depth: int=8, table_bytes: int=None,
+            prob_cutoff: float=0, max_fours: int=None):
+        """`depth` is the number of moves searched ahead, and `table_size` and `table_bytes` bound the number of entries and the memory of the transposition table.
+        Searches with a deadline deepen up to `max_depth` moves ahead. `prob_cutoff` and `max_fours` prune unlikely branches, which are all searched by default."""
+        assert game.get_size() == bitboard.SIZE, f'size must be {bitboard.SIZE}'
+        assert depth > 0, 'depth must be positive'
+        BaseAI.__init__(self, game)
+
+        self.depth = depth
+        self.prob_cutoff = prob_cutoff
+        self.max_fours = max_fours
+        self.table = EvaluationCache(table_size, table_bytes) # values of chance nodes, kept across moves
+        self.max_depth = max_depth
+        self.nodes = 0  # number of nodes searched
+        self.cutoffs = 0 # number of branches pruned
+        self.deadline = None
+        self.stats = None # SearchStats of the last move made
+
+    def make_move(self, move: Move=None, deadline_ms: float=None) -> Move:
+        """Update the game state by applying `move` or the best valid move found by the search. Returns the move made.
+        If `deadline_ms` is given, search iteratively deeper until `deadline_ms` milliseconds have passed and make the best move of the deepest completed search.
+        The depth reached and the number of nodes searched are stored in `self.stats`."""
+        start, self.nodes = time.perf_counter(), 0
+
+        depth = self.depth
+        if move is None and deadline_ms is None:
+            # Every move is evaluated at once, so that `ParallelExpectimaxAI` queues all of their tasks together
+            board = bitboard.pack(self.game_state.get_matrix(), saturate=True)
+            moves = [move for move in Move if bitboard.valid_move(board, move.value)]
+            values = self.evaluate_moves(board, moves, depth)
+            move = max(moves, key=values.get) # the first of the best moves, as in `BaseAI.make_move`
+        elif move is None:
+            move, depth = self.search(start + deadline_ms / 1000)
+        self.apply_move(move)
+
+        self.stats = SearchStats(depth, self.nodes, (time.perf_counter() - start) * 1000)
+        return move
+
+    def search(self, deadline: float) -> tuple:
+        """Search iteratively deeper until the `time.perf_counter()` value `deadline` passes and return the tuple `(move, depth)` of the deepest completed search.
+        The moves are searched in order of their value in the previous search, and a search of depth 1 always completes."""
+        board = bitboard.pack(self.game_state.get_matrix(), saturate=True)
+        moves = [move for move in Move if bitboard.valid_move(board, move.value)]
+        best_move, best_depth = moves[0], 0
+
+        try:
+            for depth in range(1, self.max_depth + 1):
+                values = self.evaluate_moves(board, moves, depth)
+                moves.sort(key=values.get, reverse=True)
+                best_move, best_depth = moves[0], depth
+                self.deadline = deadline
+        except SearchTimeout:
+            pass
+        finally:
+            self.deadline = None
+
+        return best_move, best_depth
+
+    def evaluate_move(self, move: Move) -> float:
+        """Return the expected heuristic value `self.depth` moves after applying `move`, or `None` if `move` is not valid."""
+        board = bitboard.pack(self.game_state.get_matrix(), saturate=True)
+        afterstate, _ = bitboard.slide(board, move.value)
+        if afterstate == board:
+            return None
+        return self.chance_value(afterstate, self.depth)
+
+    def evaluate_moves(self, board: int, moves: list, depth: int) -> dict:
+        """Return a dict mapping each move in `moves` to its expected heuristic value `depth` moves after applying it to `board`."""
+        return {move: self.chance_value(bitboard.slide(board, move.value)[0], depth) for move in moves}
+
+    def heuristic(self, board: int) -> float:
+        """Return the heuristic value of `board`, which must not be below `GAME_OVER_VALUE`."""
+        return heuristics.evaluate(board)
+
+    def max_value(self, board: int, depth: int, probability: float=1, fours: int=0) -> float:
+        """Return the value of the best move on `board` when `depth` moves remain to be searched.
+        `probability` is the probability of reaching `board` from the root and `fours` is the number of 4 tiles that spawned on the way."""
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % self.DEADLINE_CHECK_INTERVAL == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout
+
+        if depth == 0:
+            return self.heuristic(board)
+        if probability < self.prob_cutoff:
+            self.cutoffs += 1
+            return self.heuristic(board)
+
+        best = None
+        for move in range(len(Move)):
+            afterstate, _ = bitboard.slide(board, move)
+            if afterstate != board:
+                value = self.chance_value(afterstate, depth, probability, fours)
+                if best is None or value > best:
+                    best = value
+
+        return self.GAME_OVER_VALUE if best is None else best
+
+    def chance_value(self, board: int, depth: int, probability: float=1, fours: int=0) -> float:
+        """Return the expected value over every tile searched on `board`, where the move that produced `board` is the first of `depth` moves remaining."""
+        context = None
+        if self.cutoffs_possible():
+            context = (None if self.max_fours is None else max(0, self.max_fours - fours), round(math.log2(probability)) if self.prob_cutoff > 0 else None)
+        value, stored_context = self.table.find(board, depth, context)
+        if value is not None:
+            self.cutoffs += stored_context is not None # a pruned value prunes the path that reuses it
+            return value
+
+        self.nodes += 1
+        value, cutoffs = 0, self.cutoffs
+        for weight, outcome, outcome_fours in self.spawns(board, fours):
+            value += weight * self.max_value(outcome, depth - 1, probability * weight, outcome_fours)
+
+        self.table.put(board, depth, value, None if self.cutoffs == cutoffs else context)
+        return value
+
+    def cutoffs_possible(self) -> bool:
+        return self.prob_cutoff > 0 or self.max_fours is not None
+
+    def spawns(self, board: int, fours: int=0) -> list:
+        """Return the list of tuples `(weight, board, fours)` for every tile searched on `board`, where the weights sum to 1 and `fours` counts the 4 tiles spawned so far.
+        Once `max_fours` 4 tiles spawned, only 2 tiles are searched."""
+        clear_tiles = bitboard.empty_shifts(board)
+        spawn_4_chance = self.game_state.spawn_4_chance
+        if spawn_4_chance == 0 or (self.max_fours is not None and fours >= self.max_fours):
+            self.cutoffs += spawn_4_chance > 0
+            return [(1 / len(clear_tiles), board | (1 << shift), fours) for shift in clear_tiles]
+
+        weight_2, weight_4 = (1 - spawn_4_chance) / len(clear_tiles), spawn_4_chance / len(clear_tiles)
+        return [(weight_2, board | (1 << shift), fours) for shift in clear_tiles] + \
+            [(weight_4, board | (2 << shift), fours + 1) for shift in clear_tiles]
+
+    def __str__(self) -> str:
+        return f'Expectimax (depth {self.depth})'
+
+class ParallelExpectimaxAI(ExpectimaxAI):
+    """Searches the chance nodes below the root moves in parallel on a pool of worker processes.
+    The tiles that can spawn after the root moves are split into one batch per worker, so each worker receives a single task per search. Boards are sent to the workers as bitboards, and the workers and their transposition tables stay alive across moves. Call `close()` to shut the workers down."""
+
+    def __init__(self, game: GameState, depth: int=2, table_size: int=1 << 20, max_depth: int=8, table_bytes: int=None, workers: int=None,
+            prob_cutoff: float=0, max_fours: int=None):
+        """`workers` is the number of worker processes, which defaults to the number of CPUs. Each worker has its own transposition table bounded by `table_size` and `table_bytes`."""
+        ExpectimaxAI.__init__(self, game, depth, table_size, max_depth, table_bytes, prob_cutoff, max_fours)
+        self.workers = workers or os.cpu_count()
+        self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+            initargs=(game.spawn_4_chance, table_size, table_bytes, prob_cutoff, max_fours))
+
+    def evaluate_move(self, move: Move) -> float:
+        """Return the expected heuristic value `self.depth` moves after applying `move`, or `None` if `move` is not valid."""
+        board = bitboard.pack(self.game_state.get_matrix(), saturate=True)
+        if not bitboard.valid_move(board, move.value):
+            return None
+        return self.evaluate_moves(board, [move], self.depth)[move]
+
+    def evaluate_moves(self, board: int, moves: list, depth: int) -> dict:
+        """Return a dict mapping each move in `moves` to its expected heuristic value `depth` moves after applying it to `board`.
+        The tiles that can spawn after each move are dealt in turn to one task per worker, which balances the batches since neighbouring tiles take similar times."""
+        deadline = None if self.deadline is None else time.time() + self.deadline - time.perf_counter()
+        outcomes = [] # tuples (move, probability, board, fours)
+        for move in moves:
+            afterstate, _ = bitboard.slide(board, move.value)
+            outcomes += [(move, probability, outcome, fours) for probability, outcome, fours in self.spawns(afterstate)]
+
+        tasks = {}
+        for i in range(min(self.workers, len(outcomes))):
+            batch = outcomes[i::self.workers]
+            boards = [(outcome, probability, fours) for _, probability, outcome, fours in batch]
+            tasks[self.executor.submit(_search_worker, boards, depth - 1, deadline)] = batch
+
+        timeout = None if self.deadline is None else max(0, self.deadline - time.perf_counter())
+        done, pending = wait(tasks, timeout)
+
+        values = dict.fromkeys(moves, 0)
+        timed_out = len(pending) > 0
+        for task in pending:
+            task.cancel()
+        for task in done:
+            results, nodes = task.result()
+            self.nodes += nodes
+            if results is None:
+                timed_out = True
+            else:
+                for (move, probability, _, _), value in zip(tasks[task], results):
+                    values[move] += probability * value
+
+        if timed_out:
+            raise SearchTimeout
+        return values
+
+    def close(self):
+        """Shut down the worker processes."""
+        self.executor.shutdown(cancel_futures=True)
+
+    def __str__(self) -> str:
+        return f'Parallel Expectimax (depth {self.depth}, {self.workers} workers)'
+
+_worker_ai = None # ExpectimaxAI owned by a worker process of ParallelExpectimaxAI
+
+def _init_worker(spawn_4_chance: float, table_size: int, table_bytes: int, prob_cutoff: float=0, max_fours: int=None):
+    global _worker_ai
+    game = GameState(seed=0)
+    game.spawn_4_chance = spawn_4_chance
+    _worker_ai = ExpectimaxAI(game, table_size=table_size, table_bytes=table_bytes, prob_cutoff=prob_cutoff, max_fours=max_fours)
+
+def _search_worker(boards: list, depth: int, deadline: float=None) -> tuple:
+    """Return the tuple `(values, nodes)` of the max nodes in `boards` with `depth` moves remaining, where `values` is `None` if the `time.time()` value `deadline` passed first.
+    `boards` is a list of tuples `(board, probability, fours)`, where `probability` and `fours` are those of the path from the root to `board`, as passed to `ExpectimaxAI.max_value`."""
+    _worker_ai.nodes = 0
+    _worker_ai.deadline = None if deadline is None else time.perf_counter() + deadline - time.time()
+    try:
+        values = [_worker_ai.max_value(board, depth, probability, fours) for board, probability, fours in boards]
+    except SearchTimeout:
+        values = None
+    finally:
+        _worker_ai.deadline = None
+    return values, _worker_ai.nodes
@@ -1,19 +1,22 @@
 
 from enum import Enum, auto
 import numpy as np
-import random
+
+import bitboard
+import prng
 
 class Move(Enum):
     UP, DOWN, LEFT, RIGHT = 3, 1, 0, 2
 
 class GameState(object):
 
-    def __init__(self, size=4):
+    def __init__(self, size=4, seed: int=None):
+        """Start a new game on a board of the given size. Tiles spawn deterministically from `seed`, or from a random seed if omitted."""
         assert size != 0, 'size cannot be 0'
         self.matrix = np.zeros((size, size), dtype=np.uint32)
         self.spawn_4_chance = 0.1
         self.score = 0
-        self.random_state = random.getstate()
+        self.random_state = prng.new_state(seed) # 64-bit SplitMix64 state owned by this game state
 
         self.spawn_tile()
 
@@ -24,6 +27,12 @@ class GameState(object):
         self.score = other.score
         self.random_state = other.random_state
 
+    def copy(self):
+        """Return a copy of this game state."""
+        state = GameState.__new__(GameState)
+        state.copy_state(self)
+        return state
+
     def get_size(self) -> int:
         return len(self.matrix)
 
@@ -40,18 +49,30 @@ class GameState(object):
 
     def game_over(self) -> bool:
         """Return `True` only if there are no more valid moves remaining."""
-        if np.count_nonzero(self.matrix) < self.matrix.size:
-            return False
-
-        for move in Move:
-            if self.valid_move(move):
-                return False
-
-        return True
+        return self.valid_moves() == 0
 
     def valid_move(self, move: Move) -> bool:
         """Return whether `move` slides any tiles."""
-        return self != self.next_state(move)
+        return bool(self.valid_moves() & (1 << move.value))
+
+    def valid_moves(self) -> int:
+        """Return the bitmask of valid moves, where bit `1 << move.value` is set if `move` slides any tiles."""
+        if self.get_size() == bitboard.SIZE:
+            try:
+                return bitboard.valid_moves(bitboard.pack(self.matrix))
+            except KeyError:
+                pass # tiles cannot be represented on a bitboard
+
+        # A move slides tiles only if some tile has an empty or equal neighbour in the direction of the move
+        rows, cols = (self.matrix[:, :-1], self.matrix[:, 1:]), (self.matrix[:-1], self.matrix[1:])
+        mask = 0
+        for (first, second), forward, backward in [(rows, Move.LEFT, Move.RIGHT), (cols, Move.UP, Move.DOWN)]:
+            merge = np.any((first == second) & (first != 0))
+            if merge or np.any((first == 0) & (second != 0)):
+                mask |= 1 << forward.value
+            if merge or np.any((second == 0) & (first != 0)):
+                mask |= 1 << backward.value
+        return mask
 
     def update_state(self, move: Move):
         """Update this game state to the next game state."""
@@ -59,21 +80,57 @@ class GameState(object):
 
     def next_state(self, move: Move):
         """Return the next game state."""
-        new_matrix, points = self.slide_tiles(move)
-        
-        if points == 0 and np.array_equal(self.matrix, new_matrix):
+        if self.get_size() == bitboard.SIZE:
+            try:
+                packed = PackedState.from_state(self)
+            except KeyError:
+                pass # tiles cannot be represented on a bitboard
+            else:
+                new_state = packed.next_state(move)
+                return self if new_state is packed else new_state.to_state()
+
+        new_state = self.afterstate(move)
+
+        if new_state.score == self.score and np.array_equal(self.matrix, new_state.matrix):
             return self
 
-        new_state = GameState()
-        new_state.copy_state(self)
-        new_state.matrix = new_matrix
-        new_state.score += points
         new_state.spawn_tile()
+        return new_state
+
+    def afterstate(self, move: Move):
+        """Return the game state right after sliding tiles in the direction of `move`, before a new tile spawns."""
+        new_matrix, points = self.slide_tiles(move)
 
+        new_state = self.copy()
+        new_state.matrix = new_matrix
+        new_state.score += points
         return new_state
 
+    def spawn_outcomes(self):
+        """Generate the tuple `(probability, state)` for every tile that can spawn on this game state, so that the probabilities sum to 1."""
+        clear_tiles = np.argwhere(self.matrix == 0)
+
+        for row, col in clear_tiles:
+            for tile, chance in [(2, 1 - self.spawn_4_chance), (4, self.spawn_4_chance)]:
+                if chance > 0:
+                    new_state = self.copy()
+                    new_state.matrix[row][col] = tile
+                    yield chance / len(clear_tiles), new_state
+
     def slide_tiles(self, move: Move) -> tuple:
         """Translate and combine tiles in the specified direction if possible and return the tuple `(matrix, points)`."""
+        if self.get_size() == bitboard.SIZE:
+            try:
+                board, points = bitboard.slide(bitboard.pack(self.matrix), move.value)
+            except KeyError:
+                pass # tiles cannot be represented on a bitboard
+            else:
+                return bitboard.unpack(board), points
+
+        return self._slide_matrix(move)
+
+    def _slide_matrix(self, move: Move) -> tuple:
+        """Slide tiles of a board of any size without using a bitboard."""
         matrix = self.matrix.copy()
         matrix = np.rot90(matrix, -move.value)
         points = 0
@@ -101,16 +158,22 @@ class GameState(object):
         return matrix, points
 
     def spawn_tile(self):
-        clear_tiles = [(i,j) for i in range(len(self.matrix)) for j in range(len(self.matrix)) if self.matrix[i][j] == 0]
+        clear_tiles = np.argwhere(self.matrix == 0)
         
         try:
-            random.setstate(self.random_state)
-            row, col = random.choice(clear_tiles)
-            self.matrix[row][col] = 2 if random.random() >= self.spawn_4_chance else 4
-            self.random_state = random.getstate()
+            random_state, index = prng.next_below(self.random_state, len(clear_tiles))
+            row, col = clear_tiles[index]
+            random_state, chance = prng.next_float(random_state)
+            self.matrix[row][col] = 2 if chance >= self.spawn_4_chance else 4
+            self.random_state = random_state
         except IndexError:
             print('ERROR: Cannot spawn tile')
 
+    def canonical(self) -> tuple:
+        """Return the tuple `(state, sym)` where `state` is the canonical `PackedState` shared by the eight rotations and reflections of this 4x4 state, and `sym` is the symmetry that produces it.
+        A `Move.value` chosen on `state` maps back to this state through `bitboard.restore_move(value, sym)`."""
+        return PackedState.from_state(self).canonical()
+
     def __eq__(self, other):
         return np.array_equal(self.matrix, other.matrix) and \
             self.spawn_4_chance == other.spawn_4_chance and \
@@ -120,6 +183,116 @@ class GameState(object):
     def __str__(self):
         return str(self.matrix)
 
+class PackedState(object):
+    """An immutable and hashable 4x4 game state that stores its tiles as a bitboard (see the `bitboard` module).
+    Equal states have equal boards, so the board itself serves as the hash and equality costs a few integer comparisons."""
+
+    __slots__ = ('board', 'score', 'random_state', 'spawn_4_chance')
+
+    def __init__(self, board: int, score: int=0, random_state: int=0, spawn_4_chance: float=0.1):
+        object.__setattr__(self, 'board', board)
+        object.__setattr__(self, 'score', score)
+        object.__setattr__(self, 'random_state', random_state)
+        object.__setattr__(self, 'spawn_4_chance', spawn_4_chance)
+
+    @classmethod
+    def from_state(cls, game: GameState, saturate: bool=False):
+        """Return the packed equivalent of `game`. Raise a `KeyError` if `game` cannot be represented by a bitboard, unless `saturate` is set (see `bitboard.pack`)."""
+        assert game.get_size() == bitboard.SIZE, f'size must be {bitboard.SIZE}'
+        return cls(bitboard.pack(game.matrix, saturate), int(game.score), game.random_state, game.spawn_4_chance)
+
+    def to_state(self) -> GameState:
+        """Return the mutable `GameState` equivalent of this state."""
+        game = GameState.__new__(GameState)
+        game.matrix = bitboard.unpack(self.board)
+        game.spawn_4_chance = self.spawn_4_chance
+        game.score = self.score
+        game.random_state = self.random_state
+        return game
+
+    def get_size(self) -> int:
+        return bitboard.SIZE
+
+    def get_score(self) -> int:
+        return self.score
+
+    def get_board(self) -> int:
+        return self.board
+
+    def get_tile(self, row: int, col: int) -> int:
+        """Return the value of the tile at the specified position."""
+        return bitboard.TILES[bitboard.get_tile(self.board, row, col)]
+
+    def get_matrix(self) -> np.ndarray:
+        """Return the tiles as a NumPy `ndarray`."""
+        return bitboard.unpack(self.board)
+
+    def game_over(self) -> bool:
+        """Return `True` only if there are no more valid moves remaining."""
+        return bitboard.valid_moves(self.board) == 0
+
+    def valid_move(self, move: Move) -> bool:
+        """Return whether `move` slides any tiles."""
+        return bitboard.valid_move(self.board, move.value)
+
+    def valid_moves(self) -> int:
+        """Return the bitmask of valid moves, where bit `1 << move.value` is set if `move` slides any tiles."""
+        return bitboard.valid_moves(self.board)
+
+    def next_state(self, move: Move):
+        """Return the next game state."""
+        board, points = bitboard.slide(self.board, move.value)
+        if board == self.board:
+            return self
+
+        clear_tiles = bitboard.empty_shifts(board)
+        random_state, index = prng.next_below(self.random_state, len(clear_tiles))
+        random_state, chance = prng.next_float(random_state)
+        board |= (1 if chance >= self.spawn_4_chance else 2) << clear_tiles[index]
+
+        return PackedState(board, self.score + points, random_state, self.spawn_4_chance)
+
+    def afterstate(self, move: Move):
+        """Return the game state right after sliding tiles in the direction of `move`, before a new tile spawns."""
+        board, points = bitboard.slide(self.board, move.value)
+        return PackedState(board, self.score + points, self.random_state, self.spawn_4_chance)
+
+    def spawn_outcomes(self):
+        """Generate the tuple `(probability, state)` for every tile that can spawn on this game state, so that the probabilities sum to 1."""
+        for probability, board in bitboard.spawn_outcomes(self.board, self.spawn_4_chance):
+            yield probability, PackedState(board, self.score, self.random_state, self.spawn_4_chance)
+
+    def canonical(self) -> tuple:
+        """Return the tuple `(state, sym)` where `state` is the canonical state shared by the eight rotations and reflections of this state, and `sym` is the symmetry that produces it.
+        A `Move.value` chosen on `state` maps back to this state through `bitboard.restore_move(value, sym)`."""
+        board, sym = bitboard.canonical(self.board)
+        return PackedState(board, self.score, self.random_state, self.spawn_4_chance), sym
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __hash__(self):
+        return hash(self.board)
+
+    def __eq__(self, other):
+        return isinstance(other, PackedState) and \
+            self.board == other.board and \
+            self.score == other.score and \
+            self.random_state == other.random_state and \
+            self.spawn_4_chance == other.spawn_4_chance
+
+    def __getstate__(self):
+        return (self.board, self.score, self.random_state, self.spawn_4_chance)
+
+    def __setstate__(self, state):
+        PackedState.__init__(self, *state)
+
+    def __str__(self):
+        return str(self.get_matrix())
+
 if __name__ == '__main__':
     game = GameState()
 
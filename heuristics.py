@@ -0,0 +1,110 @@
+"""
+This module implements heuristic evaluation functions for 4x4 bitboards (see the `bitboard` module).
+
+Every term of a heuristic is computed once per possible row of four tiles and stored in a 65,536-entry lookup table. Evaluating a board then takes one lookup per row and per column, and `Heuristic.evaluate_array` evaluates a whole numpy.ndarray of boards with a handful of numpy calls.
+
+The terms, which all work on tile exponents, are:
+- empty: the number of empty tiles
+- merges: the number of pairs of equal tiles that would merge if the row slid
+- monotonicity: how far the tiles are from increasing or decreasing along the row, as a penalty
+- smoothness: the differences between neighbouring tiles, as a penalty
+- corner: the tiles weighted by how close they are to the top left corner along a snake-shaped path
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+import bitboard
+
+Weights = namedtuple('Weights', ['base', 'empty', 'merges', 'monotonicity', 'smoothness', 'corner'])
+
+DEFAULT_WEIGHTS = Weights(base=1600000, empty=270, merges=700, monotonicity=47, smoothness=10, corner=4)
+MONOTONICITY_POWER = 4
+
+# Weight of each tile for the corner term, decreasing along a snake from the top left corner
+CORNER_WEIGHTS = np.asarray([
+    [15, 14, 13, 12],
+    [ 8,  9, 10, 11],
+    [ 7,  6,  5,  4],
+    [ 0,  1,  2,  3],
+])
+
+def _row_tiles() -> np.ndarray:
+    """Return the tile exponents of every possible row as a `(65536, 4)` numpy.ndarray."""
+    rows = np.arange(1 << 16)
+    return np.stack([(rows >> (4*i)) & 0xF for i in range(bitboard.SIZE)], axis=1).astype(np.int64)
+
+def _build_terms() -> dict:
+    tiles = _row_tiles()
+    occupied = tiles > 0
+
+    # Pairs of neighbours once the empty tiles are squeezed out of the row
+    order = np.argsort(~occupied, axis=1, kind='stable')
+    compact = np.take_along_axis(tiles, order, axis=1)
+    pairs = (compact[:, :-1] > 0) & (compact[:, 1:] > 0)
+
+    # Count merges the way a slide would, where a merged tile cannot merge again
+    merges = np.zeros(len(tiles), dtype=np.int64)
+    merged = np.zeros(len(tiles), dtype=bool)
+    for i in range(bitboard.SIZE - 1):
+        merge = pairs[:, i] & (compact[:, i] == compact[:, i+1]) & ~merged
+        merges += merge
+        merged = merge
+
+    powers = tiles ** MONOTONICITY_POWER
+    steps = powers[:, 1:] - powers[:, :-1]
+    monotonicity = np.minimum(np.maximum(steps, 0).sum(axis=1), np.maximum(-steps, 0).sum(axis=1))
+
+    return {
+        'empty': (~occupied).sum(axis=1),
+        'merges': merges,
+        'monotonicity': monotonicity,
+        'smoothness': (np.abs(compact[:, 1:] - compact[:, :-1]) * pairs).sum(axis=1),
+        'corner': [tiles @ CORNER_WEIGHTS[row] for row in range(bitboard.SIZE)], # one table per row of the board
+    }
+
+TERMS = _build_terms()
+
+class Heuristic(object):
+    """A weighted sum of the terms above, clamped at 0 so that every board is worth at least as much as a lost game.
+    The weights of the penalties (monotonicity and smoothness) are subtracted. Both rows and columns count towards every term except the corner term, which only applies to the rows."""
+
+    def __init__(self, weights: Weights=DEFAULT_WEIGHTS):
+        self.weights = weights
+        lines = weights.empty * TERMS['empty'] + weights.merges * TERMS['merges'] \
+            - weights.monotonicity * TERMS['monotonicity'] - weights.smoothness * TERMS['smoothness']
+
+        # Tables indexed by row of the board, then by packed row, where the base value is spread over the rows
+        self.row_table = np.stack([lines + weights.corner * TERMS['corner'][row] + weights.base / bitboard.SIZE for row in range(bitboard.SIZE)]).astype(np.float64)
+        self.col_table = lines.astype(np.float64)
+
+        # Plain lists are used for scalar lookups since indexing them is much faster than indexing a numpy.ndarray
+        self.row_lists = self.row_table.tolist()
+        self.col_list = self.col_table.tolist()
+
+    def evaluate(self, board: int) -> float:
+        """Return the heuristic value of `board`."""
+        rows, cols = self.row_lists, self.col_list
+        transposed = bitboard.transpose(board)
+        value = rows[0][board & 0xFFFF] + rows[1][(board >> 16) & 0xFFFF] + rows[2][(board >> 32) & 0xFFFF] + rows[3][board >> 48] \
+            + cols[transposed & 0xFFFF] + cols[(transposed >> 16) & 0xFFFF] + cols[(transposed >> 32) & 0xFFFF] + cols[transposed >> 48]
+        return max(value, 0)
+
+    def evaluate_array(self, boards: np.ndarray) -> np.ndarray:
+        """Vectorized `evaluate` for a numpy.ndarray of boards with dtype numpy.uint64."""
+        boards = np.asarray(boards, dtype=np.uint64)
+        rows = ((boards[..., None] >> bitboard.ROW_SHIFTS) & bitboard.ROW_MASK).astype(np.int64)
+        cols = ((bitboard.transpose(boards)[..., None] >> bitboard.ROW_SHIFTS) & bitboard.ROW_MASK).astype(np.int64)
+        values = self.row_table[np.arange(bitboard.SIZE), rows].sum(axis=-1) + self.col_table[cols].sum(axis=-1)
+        return np.maximum(values, 0)
+
+DEFAULT = Heuristic()
+
+def evaluate(board: int) -> float:
+    """Return the value of `board` under the default heuristic."""
+    return DEFAULT.evaluate(board)
+
+def evaluate_array(boards: np.ndarray) -> np.ndarray:
+    """Return the values of `boards` under the default heuristic."""
+    return DEFAULT.evaluate_array(boards)
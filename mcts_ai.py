@@ -0,0 +1,185 @@
+import math
+import time
+from collections import namedtuple
+from threading import Lock, Thread
+
+import numpy as np
+
+import bitboard
+from ai import BaseAI
+from batch import BatchGameState
+from game import Move, GameState, PackedState
+from monte_carlo_ai import play_out
+from node_pool import NodePool
+
+TreeStats = namedtuple('TreeStats', ['iterations', 'nodes', 'time']) # time is in milliseconds
+
+class MCTSAI(BaseAI):
+    """Monte Carlo Tree Search, which grows a tree towards the moves whose random playouts score best.
+    Nodes are stored in a `NodePool` whose children are the chance outcomes of every move. Each iteration selects a move by UCT at every decision node, samples the tile that spawns according to its probability, expands the first node it reaches that has never been visited and plays a batch of random games to the end from it.
+    Each node on a path counts `VIRTUAL_LOSS` extra visits with no score until its playouts are done, which steers later descents to different paths. This lets a thread descend `batch_size` times before playing out all the nodes it reached in a single batch, and several threads descend the same tree at once.
+    The subtree of the position reached is kept from one move to the next.
+    Works on 4x4 games only, since the tree is stored on bitboards (see the `bitboard` module)."""
+
+    VIRTUAL_LOSS = 3
+
+    def __init__(self, game: GameState, iterations: int=100, threads: int=1, batch_size: int=16, playouts: int=4, exploration: float=1.0, seed=None):
+        """`iterations` is the number of iterations run per move unless a deadline is given, shared between `threads` threads which play out `batch_size` iterations at once.
+        Each iteration plays `playouts` random games from the node it expands. `exploration` is the UCT exploration constant."""
+        assert game.get_size() == bitboard.SIZE, f'size must be {bitboard.SIZE}'
+        assert min(iterations, threads, batch_size, playouts) > 0, 'iterations, threads, batch_size and playouts must be positive'
+        BaseAI.__init__(self, game)
+
+        self.iterations = iterations
+        self.threads = threads
+        self.batch_size = batch_size
+        self.playouts = playouts
+        self.exploration = exploration
+        self.random = np.random.default_rng(seed)
+        self.lock = Lock() # guards the pool and the counters below against the search threads
+
+        self.pool = NodePool(spawn_4_chance=game.spawn_4_chance)
+        self.root = self.pool.add(PackedState.from_state(game, saturate=True))
+        self.remaining = 0 # iterations left to start in the current search
+        self.stats = None # TreeStats of the last move made
+
+    def make_move(self, move: Move=None, deadline_ms: float=None) -> Move:
+        """Update the game state by applying `move` or the best valid move found by searching. Returns the move made.
+        If `deadline_ms` is given, search until `deadline_ms` milliseconds have passed instead of running `self.iterations` iterations.
+        The number of iterations run, the size of the tree and the time taken are stored in `self.stats`."""
+        start = time.perf_counter()
+        self.reroot()
+
+        iterations = 0
+        if move is None:
+            iterations = self.search(None if deadline_ms is None else start + deadline_ms / 1000)
+            move = self.best_move()
+
+        self.apply_move(move)
+        self.stats = TreeStats(iterations, len(self.pool), (time.perf_counter() - start) * 1000)
+        self.reroot(move)
+        return move
+
+    def search(self, deadline: float=None) -> int:
+        """Run iterations on `self.threads` threads until the `time.perf_counter()` value `deadline` passes, or `self.iterations` iterations if it is `None`. Returns the number of iterations run."""
+        self.remaining = self.iterations if deadline is None else math.inf
+        seeds = self.random.integers(1 << 63, size=self.threads)
+        counts = [0] * self.threads
+
+        def worker(index: int):
+            rng = np.random.default_rng(seeds[index])
+            while deadline is None or time.perf_counter() < deadline:
+                iterations = self.iterate(rng)
+                if iterations == 0:
+                    return
+                counts[index] += iterations
+
+        threads = [Thread(target=worker, args=(i,), daemon=True) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(counts)
+
+    def iterate(self, rng: np.random.Generator) -> int:
+        """Run up to `self.batch_size` iterations whose playouts run in a single batch. Returns the number of iterations run, which is 0 once the search has no iterations left."""
+        with self.lock:
+            paths = []
+            while len(paths) < self.batch_size and self.remaining > 0:
+                self.remaining -= 1
+                path = self.select(rng)
+                self.pool.visits[path] += self.VIRTUAL_LOSS
+                paths.append(path)
+            if not paths:
+                return 0
+
+            leaves = [path[-1] for path in paths]
+            batch = BatchGameState.from_boards(np.repeat(self.pool.boards[leaves], self.playouts), np.repeat(self.pool.scores[leaves], self.playouts),
+                self.pool.spawn_4_chance, rng.integers(1 << 63))
+
+        scores = play_out(batch).reshape(len(paths), self.playouts).mean(axis=1)
+
+        with self.lock:
+            for path, score in zip(paths, scores.tolist()):
+                self.pool.visits[path] -= self.VIRTUAL_LOSS - 1
+                self.pool.values[path] += score
+        return len(paths)
+
+    def select(self, rng: np.random.Generator) -> list:
+        """Return the path from the root to the node to play out from, expanding the nodes reached along the way."""
+        node, path = self.root, [self.root]
+        while True:
+            if not self.pool.is_expanded(node):
+                if node != self.root and self.pool.visits[node] == 0:
+                    return path
+                self.pool.expand([node], chance_nodes=True)
+
+            children = self.pool.get_children(node)
+            if len(children) == 0:
+                return path # the game is over
+
+            move = self.select_move(children)
+            outcomes = np.flatnonzero(self.pool.moves[children.start:children.stop] == move)
+            probabilities = np.cumsum(self.pool.probabilities[children.start:children.stop][outcomes])
+            node = children.start + int(outcomes[np.searchsorted(probabilities, rng.random() * probabilities[-1], side='right')])
+            path.append(node)
+
+    def select_move(self, children: range) -> int:
+        """Return the `Move.value` with the best UCT value among `children`, picking moves that were never tried first."""
+        visits, totals, counts = self.get_move_stats(children)
+        untried = np.flatnonzero((counts > 0) & (visits == 0))
+        if untried.size > 0:
+            return int(untried[0])
+
+        # Scores have no upper bound, so the mean score of each move is scaled to [0, 1] between the worst and best moves
+        tried = counts > 0
+        means = totals[tried] / visits[tried]
+        spread = means.max() - means.min()
+        ucb = np.full(len(Move), -np.inf)
+        ucb[tried] = (means - means.min()) / (spread if spread > 0 else 1) \
+            + self.exploration * np.sqrt(math.log(visits.sum()) / visits[tried])
+        return int(np.argmax(ucb))
+
+    def get_move_stats(self, children: range) -> tuple:
+        """Return the tuple `(visits, totals, counts)` of numpy.ndarray indexed by `Move.value`, which sum the visits, the playout scores and the number of `children` of each move."""
+        moves = self.pool.moves[children.start:children.stop]
+        visits = np.bincount(moves, self.pool.visits[children.start:children.stop], minlength=len(Move))
+        totals = np.bincount(moves, self.pool.values[children.start:children.stop], minlength=len(Move))
+        return visits, totals, np.bincount(moves, minlength=len(Move))
+
+    def best_move(self) -> Move:
+        """Return the valid move of the root with the best mean playout score.
+        With the few hundred iterations a move can afford, the mean is a much better guide than the number of visits, which UCT spreads almost evenly."""
+        if not self.pool.is_expanded(self.root):
+            self.pool.expand([self.root], chance_nodes=True)
+        visits, totals, counts = self.get_move_stats(self.pool.get_children(self.root))
+        means = np.where(visits > 0, totals / np.maximum(visits, 1), 0)
+        means[counts == 0] = -1
+        return Move(int(np.argmax(means)))
+
+    def evaluate_move(self, move: Move) -> float:
+        """Return the mean playout score through `move` from the root, or `None` if it was never tried."""
+        visits, totals, _ = self.get_move_stats(self.pool.get_children(self.root))
+        return None if visits[move.value] == 0 else totals[move.value] / visits[move.value]
+
+    def reroot(self, move: Move=None):
+        """Make the node holding the game state the root, keeping its subtree, or start a new tree if no child of the root reached by `move` holds it."""
+        board = bitboard.pack(self.game_state.get_matrix(), saturate=True)
+        if move is None:
+            if board == self.pool.boards[self.root]:
+                return
+            child = None
+        else:
+            children = self.pool.get_children(self.root)
+            matches = np.flatnonzero((self.pool.boards[children.start:children.stop] == board) & (self.pool.moves[children.start:children.stop] == move.value))
+            child = children.start + int(matches[0]) if matches.size > 0 else None
+
+        if child is None:
+            self.pool = NodePool(spawn_4_chance=self.game_state.spawn_4_chance)
+            self.root = self.pool.add(PackedState.from_state(self.game_state, saturate=True))
+        else:
+            self.pool = self.pool.subtree(child)
+            self.root = 0
+
+    def __str__(self) -> str:
+        return f'MCTS ({self.iterations} iterations, {self.threads} threads)'
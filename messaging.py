@@ -46,13 +46,7 @@ class QueueHandler(ABC):
     KILL_SIGNAL = KillSignal()
     LOGS_DIR = 'logs'
 
-    # Initialize logging settings
-    if not os.path.isdir(LOGS_DIR): os.mkdir(LOGS_DIR)
-    log_number = max([int(os.path.splitext(f)[0]) for f in os.listdir(LOGS_DIR)] + [0]) + 1
-    log_formatter = logging.Formatter('%(asctime)s :: %(name)s :: %(levelname)s :: %(message)s')
-    log_handler = logging.FileHandler(f'{LOGS_DIR}/{log_number}.log')
-    log_handler.setLevel(logging.DEBUG)
-    log_handler.setFormatter(log_formatter)
+    log_handler = None # shared by every logger, created along with its log file by the first `QueueHandler`
 
     def __init__(self):
         self.message_queue = MessageQueue()
@@ -60,7 +54,19 @@ class QueueHandler(ABC):
         # Set up logger
         self.logger = logging.getLogger(self.get_id())
         self.logger.setLevel(logging.DEBUG)
-        self.logger.addHandler(QueueHandler.log_handler)
+        self.logger.addHandler(QueueHandler.get_log_handler())
+
+    @staticmethod
+    def get_log_handler() -> logging.Handler:
+        """Return the handler writing to the log file of this process, creating the file on the first call so that importing this module leaves no trace."""
+        if QueueHandler.log_handler is None:
+            if not os.path.isdir(QueueHandler.LOGS_DIR): os.mkdir(QueueHandler.LOGS_DIR)
+            log_number = max([int(os.path.splitext(f)[0]) for f in os.listdir(QueueHandler.LOGS_DIR)] + [0]) + 1
+            log_handler = logging.FileHandler(f'{QueueHandler.LOGS_DIR}/{log_number}.log')
+            log_handler.setLevel(logging.DEBUG)
+            log_handler.setFormatter(logging.Formatter('%(asctime)s :: %(name)s :: %(levelname)s :: %(message)s'))
+            QueueHandler.log_handler = log_handler
+        return QueueHandler.log_handler
 
     def queue(self, event=None, data=None):
         """Return this object's message queue and optionally add a message to the queue."""
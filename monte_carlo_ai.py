@@ -0,0 +1,106 @@
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ai import BaseAI
+from batch import BatchGameState
+from game import Move, GameState
+
+RolloutStats = namedtuple('RolloutStats', ['playouts', 'time']) # playouts per move, time is in milliseconds
+
+class MonteCarloAI(BaseAI):
+    """Plays many games to the end with uniformly random moves from the state each valid move leads to, and makes the move with the best mean final score.
+    Every playout of every move runs at once on a `BatchGameState`, so games of any size are supported. Playouts can also be spread over a pool of worker processes; call `close()` to shut the workers down."""
+
+    def __init__(self, game: GameState, playouts: int=100, workers: int=None, seed=None):
+        """`playouts` is the number of games played per move in each round, on each worker if `workers` is given.
+        `seed` seeds the random number generator used by the playouts."""
+        assert playouts > 0, 'playouts must be positive'
+        BaseAI.__init__(self, game)
+
+        self.playouts = playouts
+        self.random = np.random.default_rng(seed)
+        self.workers = workers
+        self.executor = None if workers is None else ProcessPoolExecutor(workers)
+        self.stats = None # RolloutStats of the last move made
+
+    def make_move(self, move: Move=None, deadline_ms: float=None) -> Move:
+        """Update the game state by applying `move` or the move with the best mean playout score. Returns the move made.
+        If `deadline_ms` is given, rounds of playouts are run until the next one would end after `deadline_ms` milliseconds, and at least one round is always run.
+        The number of playouts per move and the time taken are stored in `self.stats`."""
+        start, playouts = time.perf_counter(), 0
+
+        if move is None:
+            valid_moves = self.game_state.valid_moves()
+            moves = [move for move in Move if valid_moves & (1 << move.value)]
+            states = [self.next_state(move) for move in moves]
+            totals = np.zeros(len(moves))
+            deadline = None if deadline_ms is None else start + deadline_ms / 1000
+
+            while True:
+                round_start = time.perf_counter()
+                scores = self.run_playouts(states)
+                totals += scores.sum(axis=1)
+                playouts += scores.shape[1]
+
+                now = time.perf_counter()
+                if deadline is None or now + (now - round_start) > deadline:
+                    break
+
+            # Every move has the same number of playouts, so the best total is the best mean
+            move = moves[int(np.argmax(totals))]
+
+        self.apply_move(move)
+        self.stats = RolloutStats(playouts, (time.perf_counter() - start) * 1000)
+        return move
+
+    def evaluate_move(self, move: Move) -> float:
+        """Return the mean final score of a round of playouts from the state `move` leads to."""
+        return float(self.run_playouts([self.next_state(move)]).mean())
+
+    def run_playouts(self, states: list) -> np.ndarray:
+        """Run a round of playouts from each `GameState` in `states` and return an `(len(states), playouts)` numpy.ndarray of their final scores."""
+        if self.executor is None:
+            return playout_scores(states, self.playouts, self.random.integers(1 << 63))
+
+        seeds = self.random.integers(1 << 63, size=self.workers)
+        tasks = [self.executor.submit(playout_scores, states, self.playouts, seed) for seed in seeds]
+        return np.concatenate([task.result() for task in tasks], axis=1)
+
+    def close(self):
+        """Shut down the worker processes."""
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __str__(self) -> str:
+        if self.executor is None:
+            return f'Monte Carlo ({self.playouts} playouts)'
+        return f'Monte Carlo ({self.playouts} playouts, {self.workers} workers)'
+
+def playout_scores(states: list, playouts: int, seed=None) -> np.ndarray:
+    """Play `playouts` games to the end with uniformly random moves from each `GameState` in `states`, which must have the same size.
+    Return an `(len(states), playouts)` numpy.ndarray of the final scores."""
+    batch = BatchGameState.from_states(states, seed).copy(np.repeat(np.arange(len(states)), playouts))
+    return play_out(batch).reshape(len(states), playouts)
+
+def play_out(batch: BatchGameState) -> np.ndarray:
+    """Play every game of `batch` to the end with uniformly random moves and return a numpy.ndarray of their final scores. `batch` is played in place."""
+    scores = np.zeros(len(batch), dtype=np.uint64)
+    games = np.arange(len(batch)) # index in `scores` of each game still in the batch
+
+    while len(batch) > 0:
+        valid = batch.valid_moves()
+        over = ~valid.any(axis=1)
+        if over.any():
+            scores[games[over]] = batch.get_scores()[over]
+            games, batch, valid = games[~over], batch.copy(~over), valid[~over]
+            if len(batch) == 0:
+                break
+
+        # Pick a valid move uniformly at random for every game
+        moves = np.argmax(batch.random.random(valid.shape) * valid, axis=1)
+        batch.update_state(moves)
+
+    return scores
@@ -0,0 +1,268 @@
+"""
+This module implements `NodePool`, which stores the nodes of a game search tree as a struct of arrays.
+
+A node is an index into a set of contiguous, typed numpy.ndarray (one per field) rather than a Python object, so each node takes about 44 bytes. The children of a node are always stored next to each other, so a node only records the index of its first child and how many children it has. Boards are 4x4 bitboards (see the `bitboard` module).
+
+`BoardIndex` maps boards back to the nodes holding them.
+"""
+
+import numpy as np
+
+import bitboard
+import prng
+from game import Move, PackedState
+
+MOVE_ORDER = np.asarray([move.value for move in Move], dtype=np.int8) # children are stored in the iteration order of `Move`
+
+class NodePool(object):
+
+    FIELDS = {
+        'boards': np.uint64,
+        'scores': np.uint32,
+        'random_states': np.uint64, # SplitMix64 states used to spawn tiles on the children
+        'parents': np.int32,        # -1 for a root
+        'moves': np.int8,           # `Move.value` leading from the parent, -1 for a root
+        'probabilities': np.float32, # probability of the tile spawned after the move, 1 if the spawn was sampled
+        'depths': np.uint16,        # number of moves below the root
+        'visits': np.uint32,
+        'values': np.float32,
+        'first_children': np.int32, # -1 until the node has been expanded
+        'child_counts': np.uint8,
+    }
+
+    NODE_NBYTES = sum(np.dtype(dtype).itemsize for dtype in FIELDS.values())
+
+    def __init__(self, capacity: int=1024, spawn_4_chance: float=0.1):
+        self.size = 0
+        self.spawn_4_chance = spawn_4_chance
+        for name, dtype in NodePool.FIELDS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    def __len__(self):
+        return self.size
+
+    def get_capacity(self) -> int:
+        return len(self.boards)
+
+    def get_nbytes(self) -> int:
+        """Return the number of bytes allocated by the pool."""
+        return sum(getattr(self, name).nbytes for name in NodePool.FIELDS)
+
+    def reserve(self, capacity: int):
+        """Make room for at least `capacity` nodes, at least doubling the capacity whenever the arrays are reallocated."""
+        if capacity <= self.get_capacity():
+            return
+
+        capacity = max(capacity, 2 * self.get_capacity())
+        for name in NodePool.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, state: PackedState) -> int:
+        """Add `state` as a new root and return its node."""
+        self.reserve(self.size + 1)
+        node = self.size
+        self.boards[node], self.scores[node], self.random_states[node] = state.board, state.score, state.random_state
+        self.parents[node], self.moves[node], self.depths[node], self.probabilities[node] = -1, -1, 0, 1
+        self.visits[node], self.values[node] = 0, 0
+        self.first_children[node], self.child_counts[node] = -1, 0
+        self.size += 1
+        return node
+
+    def get_state(self, node: int) -> PackedState:
+        return PackedState(int(self.boards[node]), int(self.scores[node]), int(self.random_states[node]), self.spawn_4_chance)
+
+    def get_children(self, node: int) -> range:
+        first = int(self.first_children[node])
+        return range(first, first + int(self.child_counts[node])) if first >= 0 else range(0)
+
+    def is_expanded(self, node: int) -> bool:
+        return self.first_children[node] >= 0
+
+    def expand(self, nodes: np.ndarray, chance_nodes: bool=False) -> np.ndarray:
+        """Generate the children of every node in `nodes` by applying each valid move and spawning a tile exactly as `PackedState.next_state` would.
+        If `chance_nodes` is set, every tile that can spawn after each move is a separate child instead, which inherits the generator state of its parent.
+        Return the new children, which are appended to the pool."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        boards = self.boards[nodes]
+        afterstates, points = bitboard.slide_array(boards[:, None], MOVE_ORDER[None, :])
+        valid = afterstates != boards[:, None]
+
+        # One entry per valid move of every node, in the order of `nodes` and `MOVE_ORDER`
+        owners = np.repeat(np.arange(len(nodes)), valid.sum(axis=1)) # position in `nodes` of the parent
+        moves = np.broadcast_to(MOVE_ORDER, valid.shape)[valid]
+        afterstates, points = afterstates[valid], points[valid]
+
+        if chance_nodes:
+            outcomes, children_boards, probabilities = bitboard.spawn_outcomes_array(afterstates, self.spawn_4_chance)
+            order = np.argsort(outcomes, kind='stable') # keep the children of each node next to each other
+            order = order[probabilities[order] > 0]
+            outcomes, children_boards, probabilities = outcomes[order], children_boards[order], probabilities[order]
+            owners, moves, points = owners[outcomes], moves[outcomes], points[outcomes]
+            parents = nodes[owners]
+            random_states = self.random_states[parents]
+        else:
+            parents = nodes[owners]
+            children_boards, random_states = bitboard.spawn_array(afterstates, self.random_states[parents], self.spawn_4_chance)
+            probabilities = 1
+        counts = np.bincount(owners, minlength=len(nodes))
+
+        start, n = self.size, len(parents)
+        self.reserve(start + n)
+        children = slice(start, start + n)
+        self.boards[children] = children_boards
+        self.scores[children] = self.scores[parents] + points
+        self.random_states[children] = random_states
+        self.parents[children] = parents
+        self.moves[children] = moves
+        self.probabilities[children] = probabilities
+        self.depths[children] = self.depths[parents] + 1
+        self.visits[children], self.values[children] = 0, 0
+        self.first_children[children], self.child_counts[children] = -1, 0
+
+        self.first_children[nodes] = start + np.cumsum(counts) - counts
+        self.child_counts[nodes] = counts
+        self.size += n
+        return np.arange(start, start + n)
+
+    def subtree(self, root: int, capacity: int=1024):
+        """Return a new pool holding only `root` and its descendants in level order, with `root` stored as node 0.
+        The new pool has room for at least `capacity` nodes."""
+        levels, level = [], np.asarray([root])
+        while level.size > 0:
+            levels.append(level)
+            expanded = level[self.first_children[level] >= 0]
+            level = _ranges(self.first_children[expanded], self.child_counts[expanded])
+        nodes = np.concatenate(levels)
+
+        # Map the indices of the nodes in this pool to their indices in the new pool
+        mapping = np.full(self.size, -1, dtype=np.int64)
+        mapping[nodes] = np.arange(len(nodes))
+
+        pool = NodePool(max(len(nodes), capacity), self.spawn_4_chance)
+        pool.size = len(nodes)
+        for name in NodePool.FIELDS:
+            getattr(pool, name)[:len(nodes)] = getattr(self, name)[nodes]
+
+        pool.parents[1:len(nodes)] = mapping[self.parents[nodes[1:]]]
+        pool.parents[0], pool.moves[0] = -1, -1
+        pool.depths[:len(nodes)] -= self.depths[root]
+        parents = (pool.first_children[:len(nodes)] >= 0) & (pool.child_counts[:len(nodes)] > 0)
+        pool.first_children[:len(nodes)][parents] = mapping[self.first_children[nodes[parents]]]
+        return pool
+
+    def compact(self, keep: np.ndarray, capacity: int=1024):
+        """Return a new pool holding only the nodes selected by the boolean numpy.ndarray `keep`, in the same order. `keep` must select the parent of every node it selects.
+        Nodes that lose all their children stay expanded with no children, like lost games, so they are never expanded again. The new pool has room for at least `capacity` nodes."""
+        nodes = np.flatnonzero(keep[:self.size])
+        n = len(nodes)
+        mapping = np.full(self.size, -1, dtype=np.int64)
+        mapping[nodes] = np.arange(n)
+
+        pool = NodePool(max(n, capacity), self.spawn_4_chance)
+        pool.size = n
+        for name in NodePool.FIELDS:
+            getattr(pool, name)[:n] = getattr(self, name)[nodes]
+
+        children = np.flatnonzero(pool.parents[:n] >= 0)
+        parents = mapping[pool.parents[children]]
+        pool.parents[children] = parents
+
+        # The remaining children of a node are still next to each other, starting at the first one
+        unique, first = np.unique(parents, return_index=True)
+        counts = np.bincount(parents, minlength=n)
+        pool.first_children[:n][pool.first_children[:n] >= 0] = 0
+        pool.first_children[unique] = children[first]
+        pool.child_counts[:n] = counts
+        return pool
+
+class BoardIndex(object):
+    """Maps boards to nodes with an open-addressing hash table stored in two numpy.ndarray, so that many boards are inserted or looked up at once.
+    When several nodes hold the same board, the first one inserted is kept. The table is kept at most half full and grows to between 2 and 4 slots per entry."""
+
+    ENTRY_NBYTES = 4 * (8 + 4) # upper bound on the bytes of table used per entry
+
+    def __init__(self, capacity: int=1024):
+        """`capacity` is the initial number of slots and must be a power of 2."""
+        assert capacity & (capacity - 1) == 0, 'capacity must be a power of 2'
+        self.size = 0
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.full(capacity, -1, dtype=np.int32) # -1 marks an empty slot
+
+    @classmethod
+    def from_pool(cls, pool: NodePool):
+        """Return an index of every node in `pool`."""
+        index = cls(max(1024, 1 << (2 * len(pool)).bit_length()))
+        index.insert(pool.boards[:len(pool)], np.arange(len(pool)))
+        return index
+
+    def __len__(self):
+        return self.size
+
+    def get_nbytes(self) -> int:
+        return self.keys.nbytes + self.values.nbytes
+
+    def insert(self, boards: np.ndarray, nodes: np.ndarray):
+        """Map each board in `boards` to the node at the same position in `nodes`, unless the board is already indexed."""
+        if 2 * (self.size + len(boards)) > len(self.keys):
+            self._resize(1 << (2 * (self.size + len(boards))).bit_length())
+
+        boards, nodes = np.asarray(boards, dtype=np.uint64), np.asarray(nodes)
+        slots = self._slots(boards)
+        pending = np.arange(len(boards))
+        while pending.size > 0:
+            current = slots[pending]
+            empty = self.values[current] < 0
+            found = ~empty & (self.keys[current] == boards[pending])
+
+            # Boards of the batch competing for the same empty slot are inserted in order, and the others probe that slot again
+            _, first = np.unique(current[empty], return_index=True)
+            inserted = np.zeros(len(pending), dtype=bool)
+            inserted[np.flatnonzero(empty)[first]] = True
+            self.keys[current[inserted]] = boards[pending[inserted]]
+            self.values[current[inserted]] = nodes[pending[inserted]]
+            self.size += int(inserted.sum())
+
+            collided = ~empty & ~found
+            slots[pending[collided]] = (current[collided] + 1) & (len(self.keys) - 1)
+            pending = pending[~found & ~inserted]
+
+    def lookup(self, boards: np.ndarray) -> np.ndarray:
+        """Return the node of each board in `boards`, or -1 for boards that are not indexed."""
+        boards = np.asarray(boards, dtype=np.uint64)
+        nodes = np.full(len(boards), -1, dtype=np.int64)
+        slots = self._slots(boards)
+        pending = np.arange(len(boards))
+        while pending.size > 0:
+            current = slots[pending]
+            empty = self.values[current] < 0
+            found = ~empty & (self.keys[current] == boards[pending])
+            nodes[pending[found]] = self.values[current[found]]
+
+            pending = pending[~empty & ~found]
+            slots[pending] = (slots[pending] + 1) & (len(self.keys) - 1)
+        return nodes
+
+    def get(self, board: int) -> int:
+        """Return the node of `board`, or `None` if `board` is not indexed."""
+        node = int(self.lookup(np.asarray([board], dtype=np.uint64))[0])
+        return None if node < 0 else node
+
+    def _slots(self, boards: np.ndarray) -> np.ndarray:
+        return (prng.mix_array(boards) & np.uint64(len(self.keys) - 1)).astype(np.int64)
+
+    def _resize(self, capacity: int):
+        occupied = self.values >= 0
+        boards, nodes = self.keys[occupied], self.values[occupied]
+        self.size = 0
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.full(capacity, -1, dtype=np.int32)
+        self.insert(boards, nodes)
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Return the concatenation of `range(start, start + count)` for every pair of `starts` and `counts`."""
+    counts = counts.astype(np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts.astype(np.int64), counts) + np.arange(counts.sum()) - offsets
@@ -0,0 +1,58 @@
+"""
+This module implements SplitMix64, a counter-based pseudorandom number generator whose entire state is a single 64-bit integer.
+
+Functions take a generator state and return the tuple `(state, value)`, so the caller stores the advanced state wherever it likes. This lets every game state own an independent, reproducible generator that costs a single integer to store and copy, without touching the global `random` module.
+"""
+
+import random
+
+import numpy as np
+
+MASK = (1 << 64) - 1
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+def new_state(seed: int=None) -> int:
+    """Return a generator state derived from `seed`, or a random state if `seed` is omitted."""
+    if seed is None:
+        return random.getrandbits(64)
+    return mix(seed & MASK)
+
+def mix(z: int) -> int:
+    """Return the 64-bit output of the SplitMix64 finalizer for the counter `z`."""
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK
+    return z ^ (z >> 31)
+
+def next_int(state: int) -> tuple:
+    """Return the tuple `(state, value)` where `value` is a uniformly distributed 64-bit integer."""
+    state = (state + GOLDEN_GAMMA) & MASK
+    return state, mix(state)
+
+def next_float(state: int) -> tuple:
+    """Return the tuple `(state, value)` where `value` is a uniformly distributed float in `[0, 1)`."""
+    state, value = next_int(state)
+    return state, (value >> 11) * (1.0 / (1 << 53))
+
+def next_below(state: int, n: int) -> tuple:
+    """Return the tuple `(state, value)` where `value` is a uniformly distributed integer in `[0, n)`."""
+    state, value = next_int(state)
+    return state, ((value >> 32) * n) >> 32
+
+# Vectorized variants operating on numpy.ndarray of generator states with dtype numpy.uint64, which produce the same values as the functions above
+
+def mix_array(z: np.ndarray) -> np.ndarray:
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def next_int_array(states: np.ndarray) -> tuple:
+    states = states + np.uint64(GOLDEN_GAMMA)
+    return states, mix_array(states)
+
+def next_float_array(states: np.ndarray) -> tuple:
+    states, values = next_int_array(states)
+    return states, (values >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+def next_below_array(states: np.ndarray, n: np.ndarray) -> tuple:
+    states, values = next_int_array(states)
+    return states, ((values >> np.uint64(32)) * n.astype(np.uint64)) >> np.uint64(32)
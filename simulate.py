@@ -0,0 +1,139 @@
+"""
+This module runs games of an AI without a GUI, spread over a pool of worker processes, and streams one row per game as CSV or JSON Lines.
+
+Run it through the package entry point, for example:
+
+    python . simulate expectimax --games 1000 --option depth=3 --output results.csv
+
+Game `i` is started from the seed `--seed + i`, which also seeds the AI if it takes a seed, so any game can be replayed on its own. Rows are written as soon as their game ends, so they are not in game order.
+"""
+
+import argparse
+import ast
+import csv
+import inspect
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ai import DummyAI
+from beam_search_ai import BeamSearchAI
+from expectimax_ai import ExpectimaxAI
+from game import GameState
+from mcts_ai import MCTSAI
+from monte_carlo_ai import MonteCarloAI
+
+AIS = {
+    'dummy': DummyAI,
+    'expectimax': ExpectimaxAI,
+    'beam': BeamSearchAI,
+    'montecarlo': MonteCarloAI,
+    'mcts': MCTSAI,
+}
+
+FIELDS = ['game', 'seed', 'score', 'max_tile', 'moves', 'time'] # time is in seconds
+FORMATS = ('csv', 'jsonl')
+
+def play_game(ai_name: str, options: dict, game: int, seed: int, size: int=4, max_moves: int=None) -> dict:
+    """Play a game of the AI named `ai_name` in `AIS`, built with the keyword arguments `options`, from the seed `seed`. Return its row of results."""
+    start = time.perf_counter()
+    state = GameState(size, seed)
+    ai_class = AIS[ai_name]
+    if 'seed' in inspect.signature(ai_class).parameters and 'seed' not in options:
+        options = dict(options, seed=seed)
+    ai = ai_class(state, **options)
+
+    moves = 0
+    try:
+        while not state.game_over() and (max_moves is None or moves < max_moves):
+            ai.make_move()
+            moves += 1
+    finally:
+        if hasattr(ai, 'close'):
+            ai.close()
+
+    return {
+        'game': game,
+        'seed': seed,
+        'score': int(state.get_score()),
+        'max_tile': int(state.get_matrix().max()),
+        'moves': moves,
+        'time': round(time.perf_counter() - start, 6),
+    }
+
+def run_games(ai_name: str, options: dict, games: int, seed: int=0, workers: int=None, size: int=4, max_moves: int=None):
+    """Play `games` games on `workers` processes and yield each row of results as its game ends. With a single worker the games run in this process."""
+    if workers == 1:
+        for game in range(games):
+            yield play_game(ai_name, options, game, seed + game, size, max_moves)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        tasks = [executor.submit(play_game, ai_name, options, game, seed + game, size, max_moves) for game in range(games)]
+        try:
+            for task in as_completed(tasks):
+                yield task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+def parse_option(option: str) -> tuple:
+    """Parse an option of the form `name=value`, where `value` is a Python literal or else a string."""
+    name, separator, value = option.partition('=')
+    if not separator or not name:
+        raise argparse.ArgumentTypeError(f'option must be of the form name=value: {option}')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+def parse_args(argv: list=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='simulate', description='Play games of an AI without a GUI and write one row of results per game.')
+    parser.add_argument('ai', choices=sorted(AIS), help='AI to play with')
+    parser.add_argument('-n', '--games', type=int, default=100, help='number of games to play (default: %(default)s)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the first game, incremented for each game (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--option', type=parse_option, action='append', default=[], metavar='NAME=VALUE',
+        help='keyword argument passed to the AI, such as depth=3; may be repeated')
+    parser.add_argument('--size', type=int, default=4, help='board size (default: %(default)s)')
+    parser.add_argument('--max-moves', type=int, help='stop each game after this many moves')
+    parser.add_argument('-f', '--format', choices=FORMATS, help='output format (default: from the output file extension, else csv)')
+    parser.add_argument('--output', help='file to write the rows to (default: standard output)')
+    args = parser.parse_args(argv)
+
+    if args.games < 0 or args.workers < 1:
+        parser.error('games must not be negative and workers must be positive')
+    if args.format is None:
+        args.format = 'jsonl' if args.output is not None and args.output.endswith(('.jsonl', '.json')) else 'csv'
+    return args
+
+def main(argv: list=None) -> int:
+    args = parse_args(argv)
+    output = sys.stdout if args.output is None else open(args.output, 'w', newline='')
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(output, FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda row: output.write(json.dumps(row) + '\n')
+
+        start, scores = time.perf_counter(), []
+        for row in run_games(args.ai, dict(args.option), args.games, args.seed, args.workers, args.size, args.max_moves):
+            write(row)
+            output.flush()
+            scores.append(row['score'])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - start
+    mean = sum(scores) / len(scores) if scores else 0
+    print(f'{len(scores)} games in {elapsed:.1f} s, mean score {mean:.1f}', file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,25 @@
 
 import unittest
 
+import random
+import time
+
 import numpy as np
-from game import Move, GameState
+import bitboard
+import heuristics
+import prng
+from ai import DummyAI
+from batch import BatchGameState
+from beam_search_ai import BeamSearchAI
+from benchmark import Result, compare, get_rates, sample_states, timed, to_json
+from cache import EvaluationCache
+from expectimax_ai import ExpectimaxAI, ParallelExpectimaxAI
+from game import Move, GameState, PackedState
+from mcts_ai import MCTSAI
+from monte_carlo_ai import MonteCarloAI, playout_scores
+from node_pool import NodePool, BoardIndex
+from simulate import FIELDS, parse_option, play_game, run_games
+from tree_ai import GameTree, TreeSearchAI
 
 class GameTests(unittest.TestCase):
     
@@ -87,5 +104,857 @@ class GameTests(unittest.TestCase):
         expected = [4, 4, 0, 0]
         self.compare_row(before, expected)
 
+class BitboardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(2048)
+
+    def random_matrix(self) -> np.ndarray:
+        return np.asarray([[self.rng.choice([0, 0, 2, 4, 8, 16]) for _ in range(4)] for _ in range(4)], dtype=np.uint32)
+
+    def test_pack(self):
+        for _ in range(100):
+            matrix = self.random_matrix()
+            board = bitboard.pack(matrix)
+            self.assertTrue(np.array_equal(bitboard.unpack(board), matrix))
+            self.assertTrue(np.array_equal(bitboard.unpack(bitboard.transpose(board)), matrix.T))
+
+    def test_slide(self):
+        state = GameState()
+        for _ in range(200):
+            state.matrix = self.random_matrix()
+            for move in Move:
+                board, points = bitboard.slide(bitboard.pack(state.matrix), move.value)
+                expected, expected_points = state._slide_matrix(move) # the slide used by boards of other sizes
+                self.assertTrue(np.array_equal(bitboard.unpack(board), expected), f'\nFailed {move}\n{state}')
+                self.assertEqual(points, expected_points)
+
+    def test_saturation(self):
+        board = bitboard.pack([[16384, 16384, 0, 0]] + [[0] * 4] * 3)
+        board, points = bitboard.slide(board, Move.LEFT.value)
+        self.assertEqual(bitboard.get_tile(board, 0, 0), 15)
+        self.assertEqual(points, 32768)
+        self.assertEqual(bitboard.slide(board | (15 << 4), Move.LEFT.value), (board | (15 << 4), 0))
+
+    def test_pack_saturate(self):
+        matrix = [[32768, 2, 0, 0]] + [[0] * 4] * 3
+        with self.assertRaises(KeyError):
+            bitboard.pack(matrix)
+        board = bitboard.pack(matrix, saturate=True)
+        self.assertEqual(bitboard.get_tile(board, 0, 0), 15)
+        self.assertTrue(np.array_equal(bitboard.unpack(board), matrix))
+
+class SpawnTests(unittest.TestCase):
+
+    def test_deterministic(self):
+        first, second = GameState(seed=7), GameState(seed=7)
+        self.assertEqual(first, second)
+        for move in [Move.LEFT, Move.UP, Move.RIGHT, Move.DOWN] * 5:
+            first, second = first.next_state(move), second.next_state(move)
+            self.assertEqual(first, second)
+
+    def test_global_random_untouched(self):
+        random_state = random.getstate()
+        GameState(seed=1).next_state(Move.LEFT)
+        self.assertEqual(random.getstate(), random_state)
+
+    def test_next_below(self):
+        state, counts = prng.new_state(0), [0] * 5
+        for _ in range(5000):
+            state, value = prng.next_below(state, 5)
+            counts[value] += 1
+        self.assertTrue(all(900 < count < 1100 for count in counts), counts)
+
+class AfterstateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.state = GameState(seed=11)
+        for move in [Move.LEFT, Move.UP, Move.RIGHT, Move.DOWN]:
+            self.state = self.state.next_state(move)
+
+    def test_next_state_is_an_outcome(self):
+        for move in Move:
+            if not self.state.valid_move(move):
+                continue
+            afterstate = self.state.afterstate(move)
+            outcomes = list(afterstate.spawn_outcomes())
+            self.assertAlmostEqual(sum(probability for probability, _ in outcomes), 1)
+            self.assertIn(self.state.next_state(move).get_matrix().tolist(), [state.get_matrix().tolist() for _, state in outcomes])
+            self.assertTrue(all(state.get_score() == self.state.next_state(move).get_score() for _, state in outcomes))
+
+    def test_vectorized_outcomes(self):
+        afterstate = self.state.afterstate(Move.LEFT)
+        expected = sorted((round(probability, 9), state.get_matrix().tolist()) for probability, state in afterstate.spawn_outcomes())
+
+        parents, batch, probabilities = BatchGameState.from_states([self.state]).afterstates(Move.LEFT.value).spawn_outcomes()
+        actual = sorted((round(probability, 9), matrix.tolist()) for probability, matrix in zip(probabilities, batch.get_matrices()))
+        self.assertEqual(actual, expected)
+        self.assertTrue(np.all(parents == 0))
+
+        board_outcomes = bitboard.spawn_outcomes(bitboard.pack(afterstate.get_matrix()))
+        self.assertEqual(sorted((round(probability, 9), bitboard.unpack(board).tolist()) for probability, board in board_outcomes), expected)
+
+class PackedStateTests(unittest.TestCase):
+
+    def test_matches_game_state(self):
+        game = GameState(seed=4)
+        packed = PackedState.from_state(game)
+        for move in [Move.LEFT, Move.UP, Move.RIGHT, Move.DOWN] * 5:
+            game, packed = game.next_state(move), packed.next_state(move)
+            self.assertEqual(PackedState.from_state(game), packed)
+            self.assertEqual(packed.to_state(), game)
+            self.assertEqual(packed.valid_moves(), game.valid_moves())
+
+    def test_hashable(self):
+        packed = PackedState.from_state(GameState(seed=4))
+        states = {packed, PackedState.from_state(packed.to_state()), packed.next_state(Move.LEFT), packed.next_state(Move.LEFT)}
+        self.assertEqual(len(states), 2 if packed.valid_move(Move.LEFT) else 1)
+
+    def test_immutable(self):
+        packed = PackedState.from_state(GameState(seed=4))
+        with self.assertRaises(AttributeError):
+            packed.score = 10
+
+class SymmetryTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(2048)
+        self.boards = [rng.getrandbits(64) & rng.getrandbits(64) for _ in range(200)]
+
+    def test_canonical(self):
+        for board in self.boards:
+            canonical, sym = bitboard.canonical(board)
+            self.assertEqual(bitboard.symmetry(board, sym), canonical)
+            for other in bitboard.SYMMETRIES:
+                self.assertEqual(bitboard.canonical(bitboard.symmetry(board, other))[0], canonical)
+
+        canonical, syms = bitboard.canonical_array(np.asarray(self.boards, dtype=np.uint64))
+        self.assertEqual(list(zip(canonical.tolist(), syms.tolist())), [bitboard.canonical(board) for board in self.boards])
+
+    def test_moves(self):
+        for board in self.boards:
+            for sym in bitboard.SYMMETRIES:
+                for move in Move:
+                    transformed = bitboard.transform_move(move.value, sym)
+                    self.assertEqual(bitboard.restore_move(transformed, sym), move.value)
+                    self.assertEqual(bitboard.slide(bitboard.symmetry(board, sym), transformed)[0], bitboard.symmetry(bitboard.slide(board, move.value)[0], sym))
+
+    def test_game_state(self):
+        game = GameState(seed=3).next_state(Move.LEFT)
+        state, sym = game.canonical()
+        self.assertEqual(state.get_score(), game.get_score())
+        self.assertEqual(state.get_board(), bitboard.symmetry(PackedState.from_state(game).get_board(), sym))
+
+class ValidMoveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(2048)
+
+    def test_valid_moves(self):
+        for size, tiles in [(3, [0, 2, 4, 8]), (4, [0, 2, 4, 8]), (4, [0, 32768, 65536]), (5, [0, 2, 4, 8])]:
+            state = GameState(size)
+            for _ in range(100):
+                state.matrix = np.asarray([[self.rng.choice(tiles) for _ in range(size)] for _ in range(size)], dtype=np.uint32)
+                for move in Move:
+                    expected = not np.array_equal(state._slide_matrix(move)[0], state.matrix)
+                    self.assertEqual(state.valid_move(move), expected, f'\nFailed {move}\n{state}')
+                    self.assertEqual(bool(state.valid_moves() & (1 << move.value)), expected)
+
+    def test_game_over(self):
+        state = GameState()
+        state.matrix = np.asarray([[2, 4, 2, 4], [4, 2, 4, 2]] * 2, dtype=np.uint32)
+        self.assertTrue(state.game_over())
+        state.matrix[3][3] = 0
+        self.assertFalse(state.game_over())
+        self.assertEqual(state.valid_moves(), (1 << Move.DOWN.value) | (1 << Move.RIGHT.value))
+
+class HeuristicsTests(unittest.TestCase):
+
+    def row(self, *tiles) -> int:
+        return sum(tile << (4*i) for i, tile in enumerate(tiles))
+
+    def test_row_terms(self):
+        self.assertEqual(heuristics.TERMS['empty'][self.row(1, 0, 2, 0)], 2)
+        self.assertEqual(heuristics.TERMS['merges'][self.row(1, 1, 1, 1)], 2)
+        self.assertEqual(heuristics.TERMS['merges'][self.row(1, 0, 1, 1)], 1)
+        self.assertEqual(heuristics.TERMS['monotonicity'][self.row(4, 3, 2, 1)], 0)
+        self.assertEqual(heuristics.TERMS['monotonicity'][self.row(1, 2, 1, 0)], 15)
+        self.assertEqual(heuristics.TERMS['smoothness'][self.row(1, 0, 3, 2)], 3)
+
+    def test_evaluate_array(self):
+        boards = np.asarray([random.getrandbits(64) for _ in range(200)], dtype=np.uint64)
+        self.assertEqual(heuristics.evaluate_array(boards).tolist(), [heuristics.evaluate(int(board)) for board in boards])
+        self.assertEqual(heuristics.evaluate_array(boards.reshape(20, 10)).shape, (20, 10))
+
+    def test_non_negative(self):
+        board = bitboard.pack_array(np.asarray([15, 1, 15, 1, 1, 15, 1, 15] * 2))
+        self.assertEqual(heuristics.evaluate(int(board)), 0)
+        self.assertGreater(heuristics.evaluate(bitboard.pack(GameState(seed=1).get_matrix())), 0)
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(2048)
+
+    def random_states(self, size: int, n: int=100) -> list:
+        states = [GameState(size) for _ in range(n)]
+        for state in states:
+            state.matrix = np.asarray([[self.rng.choice([0, 0, 2, 4, 8]) for _ in range(size)] for _ in range(size)], dtype=np.uint32)
+        return states
+
+    def test_slide(self):
+        for size in [3, 4, 5]:
+            states = self.random_states(size)
+            batch = BatchGameState.from_states(states)
+            moves = np.asarray([self.rng.randrange(4) for _ in states])
+
+            boards, points = batch.slide_tiles(moves)
+            batch.boards = boards
+            for state, move, matrix, batch_points in zip(states, moves, batch.get_matrices(), points):
+                expected, expected_points = state._slide_matrix(Move(move))
+                self.assertTrue(np.array_equal(matrix, expected), f'\nFailed {Move(move)}\n{state}')
+                self.assertEqual(batch_points, expected_points)
+
+    def test_large_tiles(self):
+        state = GameState(seed=1)
+        state.matrix = np.asarray([[65536, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 4]], dtype=np.uint32)
+        self.assertEqual(BatchGameState.from_states([state]).get_matrices()[0].tolist(), [[32768, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 4]])
+
+        big = GameState(5, seed=1)
+        big.matrix[0, 0] = 65536
+        self.assertEqual(BatchGameState.from_states([big]).get_matrices()[0, 0, 0], 65536)
+
+    def test_valid_moves(self):
+        for size in [3, 4]:
+            states = self.random_states(size)
+            valid = BatchGameState.from_states(states).valid_moves()
+            for state, valid_moves in zip(states, valid):
+                self.assertEqual(list(valid_moves), [state.valid_move(move) for move in sorted(Move, key=lambda m: m.value)])
+
+    def test_update_state(self):
+        for size in [3, 4]:
+            batch = BatchGameState(50, size, seed=0)
+            before = np.count_nonzero(batch.get_matrices(), axis=(1, 2))
+            changed = batch.update_state(np.full(len(batch), Move.LEFT.value))
+            after = np.count_nonzero(batch.get_matrices(), axis=(1, 2))
+            self.assertTrue(np.array_equal(after - before, changed.astype(int)))
+
+class BaseAITests(unittest.TestCase):
+
+    def test_successors_computed_once(self):
+        state = GameState(seed=3)
+        expected = state.copy()
+        calls = []
+        next_state = state.next_state
+        state.next_state = lambda move: calls.append(move) or next_state(move)
+
+        ai = DummyAI(state)
+        move = ai.make_move()
+        self.assertEqual(sorted(calls, key=lambda move: move.value), [move for move in sorted(Move, key=lambda move: move.value) if expected.valid_move(move)])
+
+        expected.update_state(move)
+        self.assertEqual(state, expected)
+        self.assertEqual(state.get_score(), expected.get_score())
+        self.assertEqual(state.random_state, expected.random_state)
+
+    def test_successors_reset_every_turn(self):
+        state = GameState(seed=3)
+        ai = DummyAI(state)
+        ai.make_move()
+        state.update_state(Move.LEFT if state.valid_move(Move.LEFT) else Move.RIGHT) # moves made outside of the AI
+        expected = state.copy()
+
+        move = ai.make_move()
+        expected.update_state(move)
+        self.assertEqual(state, expected)
+        self.assertEqual(state.random_state, expected.random_state)
+
+    def test_successors_follow_the_game(self):
+        # The GUI evaluates moves every frame while the player changes the game
+        state = GameState(seed=3)
+        ai = DummyAI(state)
+        for _ in range(5):
+            [ai.evaluate_move(move) for move in Move]
+            state.update_state(next(move for move in Move if state.valid_move(move)))
+            fresh = DummyAI(state.copy())
+            self.assertEqual([ai.evaluate_move(move) for move in Move], [fresh.evaluate_move(move) for move in Move])
+
+    def test_make_move_after_external_move(self):
+        makers = [
+            (lambda state: MonteCarloAI(state, playouts=4, seed=1), {}),
+            (lambda state: MCTSAI(state, iterations=8, seed=1), {}),
+            (lambda state: ExpectimaxAI(state, max_depth=2), {'deadline_ms': 1000}),
+        ]
+        for make_ai, kwargs in makers:
+            state = GameState(seed=3)
+            ai = make_ai(state)
+            for _ in range(3):
+                [ai.evaluate_move(move) for move in Move if state.valid_move(move)]
+                state.update_state(next(move for move in Move if state.valid_move(move)))
+                expected = state.copy()
+                move = ai.make_move(**kwargs)
+                self.assertEqual(state, expected.next_state(move), str(ai))
+
+    def test_32768_tile(self):
+        makers = [
+            (lambda state: ExpectimaxAI(state, depth=2), {}),
+            (lambda state: ExpectimaxAI(state, max_depth=2), {'deadline_ms': 1000}),
+            (lambda state: BeamSearchAI(state, width=8, depth=3, seed=1), {}),
+            (lambda state: MCTSAI(state, iterations=8, seed=1), {}),
+        ]
+        for make_ai, kwargs in makers:
+            state = GameState(seed=3)
+            state.matrix[:] = [[32768, 16384, 2, 0], [4, 8, 0, 0], [0] * 4, [0] * 4]
+            ai = make_ai(state)
+            for _ in range(3):
+                valid_moves = state.valid_moves()
+                self.assertTrue(valid_moves & (1 << ai.make_move(**kwargs).value), str(ai))
+
+class ExpectimaxTests(unittest.TestCase):
+
+    def expected_value(self, state: PackedState, depth: int) -> float:
+        """Compute the value of a chance node directly from the `PackedState` API."""
+        value = 0
+        for probability, outcome in state.spawn_outcomes():
+            if depth == 1:
+                value += probability * heuristics.evaluate(outcome.get_board())
+            else:
+                values = [self.expected_value(outcome.afterstate(move), depth - 1) for move in Move if outcome.valid_move(move)]
+                value += probability * max(values, default=ExpectimaxAI.GAME_OVER_VALUE)
+        return value
+
+    def test_evaluate_move(self):
+        state = GameState(seed=1)
+        for move in [Move.LEFT, Move.UP, Move.RIGHT, Move.DOWN] * 2:
+            state.update_state(move)
+
+        ai = ExpectimaxAI(state, depth=2)
+        for move in Move:
+            if state.valid_move(move):
+                self.assertAlmostEqual(ai.evaluate_move(move), self.expected_value(PackedState.from_state(state).afterstate(move), 2))
+            else:
+                self.assertIsNone(ai.evaluate_move(move))
+
+    def test_deadline(self):
+        state = GameState(seed=1)
+        ai = ExpectimaxAI(state, max_depth=3)
+
+        valid_moves = state.valid_moves()
+        move = ai.make_move(deadline_ms=0)
+        self.assertTrue(valid_moves & (1 << move.value))
+        self.assertEqual(ai.stats.depth, 1)
+
+        move = ai.make_move(deadline_ms=60000)
+        self.assertEqual(ai.stats.depth, 3)
+        self.assertGreater(ai.stats.nodes, 0)
+
+    def test_parallel(self):
+        state = GameState(seed=2)
+        serial, parallel = ExpectimaxAI(state, depth=2), ParallelExpectimaxAI(state, depth=2, workers=2)
+        try:
+            for _ in range(5):
+                for move in Move:
+                    expected, actual = serial.evaluate_move(move), parallel.evaluate_move(move)
+                    if expected is None:
+                        self.assertIsNone(actual)
+                    else:
+                        self.assertAlmostEqual(actual, expected)
+                serial.make_move()
+
+            twin = ExpectimaxAI(state.copy(), depth=2)
+            self.assertEqual(parallel.make_move(), twin.make_move())
+            valid_moves = state.valid_moves()
+            self.assertTrue(valid_moves & (1 << parallel.make_move(deadline_ms=50).value))
+        finally:
+            parallel.close()
+
+    def test_make_move(self):
+        state = GameState(seed=1)
+        ai = ExpectimaxAI(state, depth=2, table_size=100)
+        for _ in range(20):
+            valid_moves = state.valid_moves()
+            move = ai.make_move()
+            self.assertTrue(valid_moves & (1 << move.value))
+            self.assertLessEqual(len(ai.table), 100)
+
+    def test_table_persists(self):
+        state = GameState(seed=1)
+        ai = ExpectimaxAI(state, depth=3)
+        ai.make_move()
+        size, hits = len(ai.table), ai.table.hits
+        ai.make_move()
+        self.assertGreaterEqual(len(ai.table), size)
+        self.assertGreater(ai.table.hits, hits)
+
+    def test_pruning(self):
+        state, no_fours = GameState(seed=1), GameState(seed=1)
+        no_fours.spawn_4_chance = 0
+
+        # Without any 4 tile the search matches a game where 4 tiles never spawn
+        ai, expected = ExpectimaxAI(state, depth=2, max_fours=0), ExpectimaxAI(no_fours, depth=2)
+        for move in Move:
+            if state.valid_move(move):
+                self.assertAlmostEqual(ai.evaluate_move(move), expected.evaluate_move(move))
+
+        # Cutting off unlikely boards searches fewer nodes
+        full, pruned = ExpectimaxAI(state, depth=3), ExpectimaxAI(state, depth=3, prob_cutoff=0.001)
+        full.evaluate_move(Move.LEFT)
+        pruned.evaluate_move(Move.LEFT)
+        self.assertLess(pruned.nodes, full.nodes)
+
+        # Values of pruned subtrees are stored apart, so the values stored as exact are
+        exact = [key for key in pruned.table.entries if len(key) == 2]
+        self.assertGreater(len(exact), 0)
+        self.assertLess(len(exact), len(pruned.table))
+        for board, depth in exact:
+            self.assertAlmostEqual(pruned.table.entries[board, depth], ExpectimaxAI(state, depth=3).chance_value(board, depth))
+
+    def test_pruned_values_across_moves(self):
+        state = GameState(seed=1)
+        ai = ExpectimaxAI(state, depth=3, max_fours=1)
+        for _ in range(3):
+            ai.make_move()
+
+        # Pruned values reused from earlier moves do not make their ancestors look exact
+        expected = ExpectimaxAI(state, depth=3)
+        exact = [key for key in ai.table.entries if len(key) == 2]
+        self.assertGreater(len(exact), 0)
+        for board, depth in exact:
+            self.assertAlmostEqual(ai.table.entries[board, depth], expected.chance_value(board, depth))
+        self.assertEqual(ai.table.misses, len(ai.table)) # each search of a chance node looks it up once
+
+class MonteCarloTests(unittest.TestCase):
+
+    def test_playout_scores(self):
+        states = [GameState(seed=1), GameState(seed=2)]
+        scores = playout_scores(states, 20, seed=3)
+        self.assertEqual(scores.shape, (2, 20))
+        self.assertTrue((scores > 0).all())
+        self.assertEqual(scores.tolist(), playout_scores(states, 20, seed=3).tolist())
+        self.assertEqual(playout_scores([GameState(size=3, seed=1)], 5).shape, (1, 5))
+
+    def test_make_move(self):
+        state = GameState(seed=1)
+        ai = MonteCarloAI(state, playouts=10, seed=1)
+        for _ in range(5):
+            valid_moves = state.valid_moves()
+            self.assertTrue(valid_moves & (1 << ai.make_move().value))
+        self.assertEqual(ai.stats.playouts, 10)
+
+        ai.make_move(deadline_ms=100)
+        self.assertGreaterEqual(ai.stats.playouts, 10)
+        self.assertEqual(ai.stats.playouts % 10, 0)
+
+    def test_workers(self):
+        state = GameState(seed=1)
+        ai = MonteCarloAI(state, playouts=5, workers=2, seed=1)
+        try:
+            valid_moves = state.valid_moves()
+            self.assertTrue(valid_moves & (1 << ai.make_move().value))
+            self.assertEqual(ai.stats.playouts, 10)
+        finally:
+            ai.close()
+
+class MCTSTests(unittest.TestCase):
+
+    def test_make_move(self):
+        state = GameState(seed=1)
+        ai = MCTSAI(state, iterations=32, batch_size=8, seed=1)
+        for _ in range(3):
+            valid_moves = state.valid_moves()
+            self.assertTrue(valid_moves & (1 << ai.make_move().value))
+            self.assertEqual(ai.stats.iterations, 32)
+            self.assertEqual(ai.pool.get_state(ai.root).get_board(), bitboard.pack(state.get_matrix()))
+
+    def test_virtual_loss_removed(self):
+        ai = MCTSAI(GameState(seed=1), iterations=64, threads=2, batch_size=8, seed=1)
+        self.assertEqual(ai.search(), 64)
+        children = ai.pool.get_children(ai.root)
+        self.assertEqual(int(ai.pool.visits[children.start:children.stop].sum()), 64)
+        self.assertTrue((ai.pool.values[:len(ai.pool)] >= 0).all())
+
+    def test_deadline(self):
+        state = GameState(seed=1)
+        ai = MCTSAI(state, threads=2, batch_size=4, seed=1)
+        valid_moves = state.valid_moves()
+        self.assertTrue(valid_moves & (1 << ai.make_move(deadline_ms=100).value))
+        self.assertGreater(ai.stats.iterations, 0)
+        self.assertLess(ai.stats.time, 1000)
+
+class BeamSearchTests(unittest.TestCase):
+
+    def test_evaluate_move(self):
+        state = GameState(seed=1)
+        board = bitboard.pack(state.get_matrix())
+        ai = BeamSearchAI(state, depth=1)
+        for move in Move:
+            if state.valid_move(move):
+                self.assertAlmostEqual(ai.evaluate_move(move), heuristics.evaluate(bitboard.slide(board, move.value)[0]))
+            else:
+                self.assertIsNone(ai.evaluate_move(move))
+
+    def test_expected_spawns(self):
+        # With a beam wide enough for every outcome, each spawn makes its best move under the heuristic
+        state = GameState(seed=1)
+        ai = BeamSearchAI(state, width=64, depth=2, spawns='expected')
+        for move in Move:
+            if not state.valid_move(move):
+                continue
+            expected = 0
+            for probability, outcome in PackedState.from_state(state).afterstate(move).spawn_outcomes():
+                values = [heuristics.evaluate(outcome.afterstate(m).get_board()) for m in Move if outcome.valid_move(m)]
+                expected += probability * max(values, default=BeamSearchAI.GAME_OVER_VALUE)
+            self.assertAlmostEqual(ai.evaluate_move(move), expected, places=3)
+
+    def test_make_move(self):
+        for spawns in BeamSearchAI.SPAWN_MODES:
+            state = GameState(seed=2)
+            ai = BeamSearchAI(state, width=8, depth=6, spawns=spawns, seed=3)
+            for _ in range(20):
+                valid_moves = state.valid_moves()
+                self.assertTrue(valid_moves & (1 << ai.make_move().value))
+
+    def test_seed(self):
+        values = [BeamSearchAI(GameState(seed=1), width=4, depth=5, seed=7).evaluate_move(Move.LEFT) for _ in range(2)]
+        self.assertEqual(values[0], values[1])
+
+class SimulateTests(unittest.TestCase):
+
+    def test_play_game(self):
+        row = play_game('beam', {'width': 4, 'depth': 2}, 0, seed=1)
+        self.assertEqual(list(row), FIELDS)
+        self.assertEqual(row, dict(play_game('beam', {'width': 4, 'depth': 2}, 0, seed=1), time=row['time']))
+
+        self.assertEqual(play_game('dummy', {}, 0, seed=1, max_moves=5)['moves'], 5)
+
+    def test_run_games(self):
+        rows = list(run_games('dummy', {}, 4, seed=10, workers=2))
+        self.assertEqual(sorted(row['seed'] for row in rows), [10, 11, 12, 13])
+        serial = {row['seed']: row['score'] for row in run_games('dummy', {}, 4, seed=10, workers=1)}
+        self.assertEqual(serial, {row['seed']: row['score'] for row in rows})
+
+    def test_parse_option(self):
+        self.assertEqual(parse_option('depth=3'), ('depth', 3))
+        self.assertEqual(parse_option('spawns=expected'), ('spawns', 'expected'))
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_sample_states(self):
+        states, again = sample_states(n=8), sample_states(n=8)
+        self.assertEqual(states, again)
+        for state in states:
+            self.assertTrue((state.get_matrix() == 0).any())
+
+    def test_timed(self):
+        calls = []
+        elapsed = timed(lambda value: calls.append(value), rounds=3, warmup=2, setup=lambda: len(calls))
+        self.assertEqual(calls, [0, 1, 2, 3, 4])
+        self.assertGreaterEqual(elapsed, 0)
+
+    def test_compare(self):
+        comparisons = compare({'a': 100, 'b': 70, 'c': 5}, {'a': 80, 'b': 100}, tolerance=0.2)
+        self.assertEqual([(c.name, c.regressed) for c in comparisons], [('a', False), ('b', True)])
+        self.assertAlmostEqual(comparisons[0].ratio, 1.25)
+
+    def test_to_json(self):
+        data = to_json([Result('a', 100.0, 'calls/s')], repeat=5, rounds=2, tolerance=0.3)
+        self.assertEqual((data['repeat'], data['rounds'], data['tolerance']), (5, 2, 0.3)) # a comparison measures as the baseline was measured
+        self.assertEqual(get_rates(data), {'a': 100.0})
+
+class CacheTests(unittest.TestCase):
+
+    def test_lru(self):
+        cache = EvaluationCache(max_entries=2)
+        cache.put(1, 1, 10)
+        cache.put(2, 1, 20)
+        self.assertEqual(cache.get(1, 1), 10) # 2 is now the least recently used
+        cache.put(3, 1, 30)
+
+        self.assertIsNone(cache.get(2, 1))
+        self.assertEqual(cache.get(1, 1), 10)
+        self.assertIsNone(cache.get(1, 2))
+        self.assertEqual(cache.get_stats(), (2, 2, 2, 1))
+
+    def test_context(self):
+        cache = EvaluationCache()
+        cache.put(1, 2, 3.0, context='pruned')
+        self.assertIsNone(cache.get(1, 2))
+        self.assertEqual(cache.get(1, 2, 'pruned'), 3.0)
+
+        # Exact values come first, and a single hit or miss is counted either way
+        self.assertEqual(cache.find(1, 2, 'pruned'), (3.0, 'pruned'))
+        cache.put(1, 2, 4.0)
+        self.assertEqual(cache.find(1, 2, 'pruned'), (4.0, None))
+        self.assertEqual(cache.find(5, 2, 'pruned'), (None, None))
+        self.assertEqual(cache.get_stats(), (2, 3, 2, 0))
+
+    def test_max_bytes(self):
+        cache = EvaluationCache(max_bytes=100 * EvaluationCache.ENTRY_NBYTES)
+        for board in range(1000):
+            cache.put(board, 0, board)
+        self.assertEqual(len(cache), 100)
+        self.assertEqual(cache.evictions, 900)
+        self.assertLessEqual(cache.get_nbytes(), 100 * EvaluationCache.ENTRY_NBYTES)
+
+class GameTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = GameTree(GameState(seed=5))
+
+    def tearDown(self):
+        self.tree.kill_thread()
+
+    def wait_for_depth(self, depth: int, timeout: float=10):
+        end = time.time() + timeout
+        while self.tree.get_depth() < depth:
+            self.assertLess(time.time(), end, 'tree did not grow in time')
+            time.sleep(0.001)
+
+    def test_level_order(self):
+        self.wait_for_depth(4)
+        depths = self.tree.pool.depths[self.tree.get_leaves()].tolist()
+        self.assertEqual(depths, sorted(depths))
+        self.assertLessEqual(depths[-1] - depths[0], 1)
+
+    def test_update(self):
+        self.wait_for_depth(4)
+        size = self.tree.get_size()
+        root = self.tree.get_state(self.tree.root)
+        move = next(move for move in Move if root.valid_move(move))
+        self.tree.update(move)
+
+        self.assertEqual(self.tree.get_state(self.tree.root), root.next_state(move))
+        self.assertIsNone(self.tree.get_parent(self.tree.root))
+        self.assertLess(self.tree.get_size(), size)
+
+        root = self.tree.get_state(self.tree.root)
+        for leaf in self.tree.get_leaves()[:50]:
+            state = root
+            for move in self.tree.get_move_history(leaf):
+                state = state.next_state(move)
+            self.assertEqual(state, self.tree.get_state(leaf))
+
+    def test_first_moves(self):
+        self.wait_for_depth(3)
+        leaves = self.tree.get_leaves()[:50]
+        self.assertEqual(self.tree.get_first_moves(leaves).tolist(), [self.tree.get_move_history(leaf)[0].value for leaf in leaves])
+        self.assertEqual(self.tree.get_first_moves([self.tree.root]).tolist(), [-1])
+
+    def test_update_chance_node(self):
+        self.tree.kill_thread()
+        game = GameState(seed=6)
+        self.tree = GameTree(game, chance_nodes=True)
+        self.wait_for_depth(2)
+
+        move = next(move for move in Move if game.valid_move(move))
+        game.update_state(move)
+        self.tree.update(move, game)
+        self.assertEqual(self.tree.get_state(self.tree.root).get_board(), bitboard.pack(game.get_matrix()))
+        self.assertGreater(self.tree.get_size(), 1)
+        self.assertEqual(self.tree.find(game), self.tree.root)
+
+    def test_update_unexpected_spawn(self):
+        self.wait_for_depth(2)
+        game = self.tree.get_state(self.tree.root).to_state()
+        game.random_state = prng.new_state(7)
+        move = next(move for move in Move if game.valid_move(move))
+        game.update_state(move)
+        self.tree.update(move, game)
+
+        self.assertEqual(self.tree.get_state(self.tree.root).get_board(), bitboard.pack(game.get_matrix()))
+        self.assertIsNone(self.tree.get_parent(self.tree.root))
+
+    def wait_for_complete(self, timeout: float=10):
+        """Wait until the tree stopped growing by itself."""
+        end = time.time() + timeout
+        while not self.tree.is_complete():
+            self.assertLess(time.time(), end, 'tree did not fill its budget in time')
+            time.sleep(0.001)
+
+    def test_budget(self):
+        self.tree.kill_thread()
+        self.tree = GameTree(GameState(seed=5), max_nodes=5000)
+        self.wait_for_complete()
+
+        with self.tree.lock:
+            self.assertGreater(self.tree.evicted, 0)
+            self.assertLessEqual(self.tree.get_size(), 5000)
+            self.assertEqual(self.tree.pool.get_capacity(), 5000)
+            root = self.tree.get_state(self.tree.root)
+            for leaf in self.tree.get_leaves()[:50]:
+                state = root
+                for move in self.tree.get_move_history(leaf):
+                    state = state.next_state(move)
+                self.assertEqual(state, self.tree.get_state(leaf))
+
+    def test_budget_branches(self):
+        self.tree.kill_thread()
+        self.tree = GameTree(GameState(seed=5), chance_nodes=True, max_nodes=20000)
+        self.wait_for_complete()
+
+        with self.tree.lock:
+            # Every move keeps leaves below it, and the tree stays within its budget
+            self.assertGreater(self.tree.evicted, 0)
+            self.assertLessEqual(self.tree.get_size(), 20000)
+            moves = self.tree.get_first_moves(self.tree.get_leaves())
+            valid_moves = {move.value for move in Move if self.tree.get_state(self.tree.root).valid_move(move)}
+            self.assertEqual(set(moves.tolist()), valid_moves)
+
+        # Once full, the tree stops growing
+        self.wait_for_idle()
+        evicted = self.tree.evicted
+        time.sleep(0.1)
+        self.assertEqual(self.tree.evicted, evicted)
+
+        # Whichever tile spawns, the tree grows again from the new root
+        with self.tree.lock:
+            child = self.tree.get_children(self.tree.root)[-1]
+            move, game = self.tree.get_move(child), self.tree.get_state(child).to_state()
+        self.tree.update(move, game)
+        end = time.time() + 10
+        while self.tree.get_depth() < 2:
+            self.assertLess(time.time(), end, 'tree did not grow after the update')
+            time.sleep(0.001)
+
+    def wait_for_idle(self, timeout: float=10):
+        """Wait until growth stopped and every queued event was handled."""
+        end = time.time() + timeout
+        while self.tree.scheduled or not self.tree.queue().empty():
+            self.assertLess(time.time(), end, 'tree did not stop growing in time')
+            time.sleep(0.001)
+        time.sleep(0.05) # let the last event finish
+
+    def test_pause_resume(self):
+        self.tree.pause()
+        self.wait_for_idle()
+        size = self.tree.get_size()
+        time.sleep(0.05)
+        self.assertEqual(self.tree.get_size(), size)
+
+        self.tree.resume()
+        self.wait_for_depth(self.tree.get_depth() + 1)
+        self.assertGreater(self.tree.get_size(), size)
+
+    def test_target_depth(self):
+        self.tree.kill_thread()
+        self.tree = GameTree(GameState(seed=5), target_depth=3)
+        self.wait_for_depth(3)
+        self.wait_for_idle()
+        self.assertTrue(self.tree.is_complete())
+        self.assertEqual(self.tree.get_depth(), 3)
+
+        root = self.tree.get_state(self.tree.root)
+        self.tree.update(next(move for move in Move if root.valid_move(move)))
+        self.wait_for_depth(3)
+        self.assertEqual(self.tree.get_depth(), 3)
+
+    def measure_growth(self, duration: float=1.5) -> tuple:
+        """Return the tuple `(rate, cpu)` of the leaves expanded per second and the fraction of a CPU used by the process over the next `duration` seconds."""
+        time.sleep(0.2) # skip the first batches
+        start, cpu, frontier = time.perf_counter(), time.process_time(), self.tree.frontier
+        time.sleep(duration)
+        elapsed = time.perf_counter() - start
+        return (self.tree.frontier - frontier) / elapsed, (time.process_time() - cpu) / elapsed
+
+    def test_max_rate(self):
+        self.tree.kill_thread()
+        self.tree = GameTree(GameState(seed=5), max_rate=2000)
+        rate, _ = self.measure_growth()
+        self.assertGreater(rate, 2000 * 0.7)
+        self.assertLess(rate, 2000 * 1.2)
+
+    def test_cpu_share(self):
+        self.tree.kill_thread()
+        self.tree = GameTree(GameState(seed=5), cpu_share=0.25)
+        _, cpu = self.measure_growth()
+        self.assertGreater(cpu, 0.25 * 0.6)
+        self.assertLess(cpu, 0.25 * 1.4)
+
+class TreeSearchTests(unittest.TestCase):
+
+    def test_make_move(self):
+        state = GameState(seed=1)
+        ai = TreeSearchAI(state, max_nodes=20000)
+        try:
+            for _ in range(5):
+                end = time.time() + 10
+                while ai.tree.get_depth() < 2:
+                    self.assertLess(time.time(), end, 'tree did not grow in time')
+                    time.sleep(0.001)
+
+                valid_moves = state.valid_moves()
+                move = ai.make_move()
+                self.assertTrue(valid_moves & (1 << move.value))
+
+                # The tree follows the game from the tile that spawned
+                with ai.tree.lock:
+                    self.assertEqual(ai.tree.pool.boards[ai.tree.root], bitboard.pack(state.get_matrix()))
+        finally:
+            ai.tree.kill_thread()
+
+class NodePoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = NodePool(capacity=4)
+        self.pool.add(PackedState.from_state(GameState(seed=5)))
+        self.pool.expand([0])
+        self.pool.expand(np.arange(1, len(self.pool)))
+
+    def test_expand(self):
+        for node in range(1, len(self.pool)):
+            parent = int(self.pool.parents[node])
+            expected = self.pool.get_state(parent).next_state(Move(int(self.pool.moves[node])))
+            self.assertEqual(self.pool.get_state(node), expected)
+            self.assertIn(node, self.pool.get_children(parent))
+            self.assertEqual(self.pool.depths[node], self.pool.depths[parent] + 1)
+
+    def test_subtree(self):
+        child = self.pool.get_children(0)[-1]
+        subtree = self.pool.subtree(child)
+
+        self.assertEqual(len(subtree), 1 + len(self.pool.get_children(child)))
+        self.assertEqual(subtree.get_state(0), self.pool.get_state(child))
+        self.assertEqual([subtree.get_state(node) for node in subtree.get_children(0)], [self.pool.get_state(node) for node in self.pool.get_children(child)])
+        self.assertTrue(all(subtree.parents[node] == 0 for node in subtree.get_children(0)))
+
+    def test_compact(self):
+        keep = np.ones(len(self.pool), dtype=bool)
+        dropped = self.pool.get_children(1)
+        keep[dropped.start:dropped.stop] = False
+        keep[self.pool.get_children(2)[0]] = False
+        pool = self.pool.compact(keep)
+
+        self.assertEqual(len(pool), keep.sum())
+        self.assertTrue(pool.is_expanded(1)) # a node that lost all its children is never expanded again
+        self.assertEqual(len(pool.get_children(1)), 0)
+        self.assertEqual(len(pool.get_children(2)), len(self.pool.get_children(2)) - 1)
+        for node in range(1, len(pool)):
+            self.assertIn(node, pool.get_children(int(pool.parents[node])))
+
+    def test_expand_chance_nodes(self):
+        pool = NodePool()
+        root = pool.add(PackedState.from_state(GameState(seed=5)))
+        pool.expand([root], chance_nodes=True)
+        board = int(pool.boards[root])
+
+        expected = []
+        for move in Move:
+            afterstate, _ = bitboard.slide(board, move.value)
+            if afterstate != board:
+                expected += [(move.value, outcome) for _, outcome in bitboard.spawn_outcomes(afterstate)]
+        children = pool.get_children(root)
+        self.assertEqual(sorted((int(pool.moves[child]), int(pool.boards[child])) for child in children), sorted(expected))
+        for move in set(pool.moves[children.start:children.stop]):
+            self.assertAlmostEqual(pool.probabilities[children.start:children.stop][pool.moves[children.start:children.stop] == move].sum(), 1, places=5)
+
+    def test_board_index(self):
+        index = BoardIndex(capacity=4)
+        boards = np.asarray([random.getrandbits(64) for _ in range(1000)] * 2, dtype=np.uint64)
+        index.insert(boards, np.arange(len(boards)))
+
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(index.lookup(boards).tolist(), list(range(1000)) * 2)
+        self.assertIsNone(index.get(int(boards[0]) ^ 1))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
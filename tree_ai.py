@@ -1,84 +1,289 @@
 
 from abc import abstractmethod
+from threading import RLock
 import numpy as np
 
+import bitboard
+import heuristics
 from ai import BaseAI
-from game import Move, GameState
+from game import Move, GameState, PackedState
 from messaging import QueueHandler, UnknownEventError
+from node_pool import NodePool, BoardIndex
 
 import time
 
-class GameNode(object):
-    """Stores game state as data."""
+class GameTree(QueueHandler):
+    """Represents a game search tree that uses background threads to continually grow.
+    Nodes are indices into a `NodePool`, so only 4x4 games are supported. The pool is kept in level order, apart from the children of leaves left above the deepest level by an eviction until the next one, and the tree grows by expanding its leaves in pool order, the first of which is `self.frontier`.
+    If `chance_nodes` is set, every tile that can spawn after a move gets its own child, so the tree keeps its subtree whichever tile actually spawns. Otherwise each move has a single child whose tile is drawn from the generator state of the game.
+    The size of the tree can be bounded by a number of nodes or of bytes, past which the leaves with the lowest heuristic values below each child of the root are evicted. Nodes left without children by an eviction are closed rather than expanded again, and the tree stops growing once evictions no longer free room for it.
+    Growth can be paused and resumed, throttled to a number of leaves expanded per second or to a share of the CPU time of its thread, and stops by itself at a target depth or number of nodes, or once the budget is full, until the next `update()`."""
 
-    def __init__(self, game: GameState=None, parent: GameState=None, move: Move=None):
-        """A node representing a game state, where `move` is how `game` can be reached from `parent`.
-        The value for `game` can be omitted if a value for both `parent` and `move` are provided."""
-        if game is not None:
-            self.game_state = game
-        else:
-            assert parent.game_state.valid_move(move)
-            self.game_state = parent.game_state.next_state(move)
+    GROWTH_BATCH = 256 # number of leaves expanded at once
+    EVICTION_FRACTION = 0.25 # fraction of the node budget freed by each eviction
+    MAX_EVICTED = 4 # number of budgets' worth of nodes evicted between updates, past which the tree is full
 
-        self.parent = parent
-        self.move = move
-        self.move_history = np.empty(0) if parent is None else np.append(parent.move_history, move) # numpy.ndarray for performance
-        self.children = None
+    def __init__(self, game: GameState, chance_nodes: bool=False, max_nodes: int=None, max_bytes: int=None,
+            target_depth: int=None, target_size: int=None, max_rate: float=None, cpu_share: float=None):
+        """`max_nodes` and `max_bytes` bound the number of nodes and of bytes allocated by the tree, and are unbounded if omitted.
+        Growth stops once the tree is `target_depth` moves deep or holds `target_size` nodes, and is throttled to `max_rate` leaves expanded per second and to the fraction `cpu_share` of the time of its thread."""
+        assert cpu_share is None or 0 < cpu_share <= 1, 'cpu_share must be in (0, 1]'
+        assert game.get_size() == bitboard.SIZE, f'size must be {bitboard.SIZE}'
+        QueueHandler.__init__(self)
 
-    def get_children(self) -> list:
-        """Returns the children of this node in a list."""
-        if self.children is None:
-            self.children = [GameNode(parent=self, move=m) for m in Move if self.game_state.valid_move(m)]
-        return self.children
+        self.chance_nodes = chance_nodes
+        self.max_children = len(Move) * 2 * bitboard.SIZE ** 2 if chance_nodes else len(Move) # bound on the children of a node
 
-    def __repr__(self):
-        """For testing purposes."""
-        return f'move: {self.move}, history: {self.move_history}\n{self.game_state}'
+        self.max_nodes = max_nodes
+        if max_bytes is not None:
+            limit = max_bytes // (NodePool.NODE_NBYTES + BoardIndex.ENTRY_NBYTES)
+            self.max_nodes = limit if max_nodes is None else min(max_nodes, limit)
+        assert self.max_nodes is None or self.max_nodes > 2 * self.max_children, 'budget is too small'
+        self.capacity = 1024 if self.max_nodes is None else self.max_nodes # the pool never grows past its initial capacity under a budget
+        self.evicted = 0 # number of nodes evicted so far
 
-class GameTree(QueueHandler):
-    """Represents a game search tree that uses background threads to continually grow."""
+        self.target_depth, self.target_size = target_depth, target_size
+        self.max_rate, self.cpu_share = max_rate, cpu_share
+        self.paused = False
+        self.scheduled = False # whether an 'autogrow' event is queued
 
-    def __init__(self, game: GameState):
-        BaseAI.__init__(self, game)
-        QueueHandler.__init__(self)
-
-        self.root = GameNode(game)
-        self.leaves = np.asarray([self.root]) # numpy.ndarray for performance
+        self.lock = RLock() # guards the pool against the growing thread
+        self.reset(game)
 
         self.launch_thread()
 
     def get_leaves(self) -> np.ndarray:
-        """Return the leaves of the tree as a numpy.ndarray."""
-        return self.leaves
+        """Return the leaves of the tree in pool order."""
+        with self.lock:
+            return self.frontier + np.flatnonzero(self.pool.first_children[self.frontier:len(self.pool)] < 0)
 
     def get_depth(self) -> int:
         """Returns the depth of the tree."""
-        return self.get_leaves()[-1].move_history.size - self.root.move_history.size
+        with self.lock:
+            return int(self.pool.depths[:len(self.pool)].max())
+
+    def get_size(self) -> int:
+        """Returns the number of nodes in the tree."""
+        return len(self.pool)
+
+    def get_nbytes(self) -> int:
+        """Returns the number of bytes allocated by the pool and the board index."""
+        return self.pool.get_nbytes() + self.index.get_nbytes()
+
+    def get_state(self, node: int) -> PackedState:
+        return self.pool.get_state(node)
+
+    def get_move(self, node: int) -> Move:
+        """Returns the move that leads to `node` from its parent, or `None` for the root."""
+        move = int(self.pool.moves[node])
+        return None if move < 0 else Move(move)
+
+    def get_parent(self, node: int) -> int:
+        """Returns the parent of `node`, or `None` for the root."""
+        parent = int(self.pool.parents[node])
+        return None if parent < 0 else parent
+
+    def get_children(self, node: int) -> range:
+        """Returns the children of `node`, which are empty until `node` has been expanded."""
+        return self.pool.get_children(node)
+
+    def get_branches(self, nodes: np.ndarray) -> np.ndarray:
+        """Returns the child of the root that each node in `nodes` descends from, or the root for the root itself."""
+        with self.lock:
+            nodes = np.array(nodes, dtype=np.int64)
+            for _ in range(int(self.pool.depths[nodes].max(initial=0)) - 1):
+                deep = self.pool.depths[nodes] > 1
+                nodes[deep] = self.pool.parents[nodes[deep]]
+            return nodes
+
+    def get_first_moves(self, nodes: np.ndarray) -> np.ndarray:
+        """Returns the `Move.value` of the first move leading from the root to each node in `nodes`, or -1 for the root."""
+        with self.lock:
+            branches = self.get_branches(nodes)
+            return np.where(self.pool.depths[branches] > 0, self.pool.moves[branches], -1)
+
+    def get_move_history(self, node: int) -> list:
+        """Returns the moves that lead from the root to `node`."""
+        history = []
+        while self.get_parent(node) is not None:
+            history.append(self.get_move(node))
+            node = self.get_parent(node)
+        return history[::-1]
+
+    def find(self, game: GameState) -> int:
+        """Returns a node holding the board of `game`, or `None` if there is none."""
+        with self.lock:
+            return self.index.get(bitboard.pack(game.get_matrix(), saturate=True))
 
-    def update(self, move: Move):
-        """Update the tree by making the move defined by `move`. Requires that `move` is a valid move."""
-        self.root = {child.move: child for child in self.root.get_children()}[move]
-        
-        # Trim out unreachable nodes using the move history of the root
-        move_filter = np.vectorize(lambda x: np.array_equal(x.move_history[:self.root.move_history.size], self.root.move_history))
-        self.leaves = self.leaves[move_filter(self.leaves)]
-        if self.leaves.size == 0: self.leaves = np.asarray([self.root])
+    def reset(self, game: GameState):
+        """Discard the tree and start over from `game`."""
+        with self.lock:
+            self.pool = NodePool(self.capacity, game.spawn_4_chance)
+            self.root = self.pool.add(PackedState.from_state(game, saturate=True))
+            self.frontier = self.root # index of the first leaf
+            self.index = BoardIndex.from_pool(self.pool)
+            self.full = False # whether the budget is full and nothing is left to evict
+            self.evicted_before = self.evicted # number of nodes evicted before the last update or reset
+
+    def update(self, move: Move, game: GameState=None):
+        """Update the tree by making the move defined by `move`, after which the game reached `game`. Requires that `move` is a valid move.
+        The subtree of the child matching the board of `game` is kept, and the tree starts over from `game` if no child matches because an unexpected tile spawned.
+        `game` may only be omitted if the tree has no chance nodes, in which case the child drawn by the tree is kept."""
+        assert game is not None or not self.chance_nodes, 'game is required to pick a chance node'
+        with self.lock:
+            if not self.pool.is_expanded(self.root):
+                self._expand(np.arange(self.root, self.root + 1))
+                self._advance()
+
+            children = self.get_children(self.root)
+            if game is None:
+                child = next(child for child in children if self.get_move(child) == move)
+            else:
+                board = bitboard.pack(game.get_matrix(), saturate=True)
+                child = self.index.get(board)
+                if child not in children or self.get_move(child) != move:
+                    # The index keeps a single node per board, which may be a transposition elsewhere in the tree
+                    matches = np.flatnonzero((self.pool.boards[children.start:children.stop] == board) & (self.pool.moves[children.start:children.stop] == move.value))
+                    child = children.start + int(matches[0]) if matches.size > 0 else None
+
+            if child is None:
+                self.reset(game)
+            else:
+                # Keep only the subtree of the new root, which releases the rest of the pool
+                self.pool = self.pool.subtree(child, self.capacity)
+                self.root = 0
+                self.full = False
+                self.evicted_before = self.evicted
+                self._rebuild()
+        self.queue('wake') # growth may have stopped at a target that the new tree no longer reaches
+
+    def evict(self):
+        """Prune leaves until about `(1 - EVICTION_FRACTION) * max_nodes` nodes remain. Nodes left without children are closed, so they are never expanded again.
+        The same share of the leaves below each child of the root is evicted, those with the lowest heuristic values first, so that the tree stays ready for whichever move and tile come next.
+        The root, its children and the last leaf below each of them are never evicted. Nothing is evicted if that leaves too many nodes or once `MAX_EVICTED` budgets' worth of nodes were evicted since the last update, so that the tree stops growing.
+        Restores the level order of the pool, which breaks once leaves left above the deepest level are expanded."""
+        with self.lock:
+            n = len(self.pool)
+            leaves = self.get_leaves()
+            leaves = leaves[self.pool.depths[leaves] > 1]
+            excess = n - int(self.max_nodes * (1 - GameTree.EVICTION_FRACTION))
+            if excess <= 0 or leaves.size == 0 or self.evicted - self.evicted_before >= GameTree.MAX_EVICTED * self.max_nodes:
+                return
+
+            # Sort the leaves by branch, then by value, and evict the first leaves of each branch
+            branches = self.get_branches(leaves)
+            order = np.lexsort((heuristics.evaluate_array(self.pool.boards[leaves]), branches))
+            leaves, branches = leaves[order], branches[order]
+            _, first, counts = np.unique(branches, return_index=True, return_counts=True)
+            if excess > len(leaves) - len(counts):
+                return
+            ranks = np.arange(len(leaves)) - np.repeat(first, counts)
+            quotas = np.minimum(np.ceil(counts * excess / len(leaves)), counts - 1).astype(np.int64)
+
+            keep = np.ones(n, dtype=bool)
+            keep[leaves[ranks < np.repeat(quotas, counts)]] = False
+            self.evicted += n - int(keep.sum())
+            self.pool = self.pool.compact(keep, self.capacity)
+            depths = self.pool.depths[:len(self.pool)]
+            if (depths[1:] < depths[:-1]).any():
+                self.pool = self.pool.subtree(self.root, self.capacity)
+            self._rebuild()
+
+    def pause(self):
+        """Stop growing the tree once the batch being grown is done."""
+        self.queue('pause')
+
+    def resume(self):
+        """Resume growing the tree after `pause()`."""
+        self.queue('resume')
+
+    def is_complete(self) -> bool:
+        """Returns whether the tree reached `target_depth` or `target_size`, has no leaves left to expand or is full."""
+        with self.lock:
+            return self.frontier == len(self.pool) or self.full \
+                or (self.target_depth is not None and self.get_depth() >= self.target_depth) \
+                or (self.target_size is not None and len(self.pool) >= self.target_size)
 
     def handle_event(self, event, data):
         if event == 'autogrow': # data is number of leafs
-            self.grow()
-            self.queue('autogrow', self.get_leaves().size)
+            self.scheduled = False
+            if self.paused or self.is_complete():
+                return
+            start = time.perf_counter()
+            leaves = self.grow()
+            self.throttle(leaves, time.perf_counter() - start)
+            self.schedule()
+        elif event == 'pause':
+            self.paused = True
+        elif event == 'resume':
+            self.paused = False
+            self.schedule()
+        elif event == 'wake':
+            self.schedule()
         else:
             raise UnknownEventError
 
+    def schedule(self):
+        """Queue the next batch of growth unless one is queued already, growth is paused or the tree is complete. Only called by the worker thread."""
+        if not self.scheduled and not self.paused and not self.is_complete():
+            self.scheduled = True
+            self.queue('autogrow', len(self.get_leaves()))
+
+    def throttle(self, leaves: int, elapsed: float):
+        """Sleep long enough after expanding `leaves` leaves in `elapsed` seconds to respect `max_rate` and `cpu_share`."""
+        delay = 0
+        if self.max_rate is not None:
+            delay = max(delay, leaves / self.max_rate - elapsed)
+        if self.cpu_share is not None:
+            delay = max(delay, elapsed * (1 - self.cpu_share) / self.cpu_share)
+        if delay > 0:
+            time.sleep(delay)
+
     def launch_thread(self):
         QueueHandler.launch_thread(self)
-        self.queue('autogrow', self.get_leaves().size) # Launch the auto-growing mechanism
+        self.queue('wake') # Launch the auto-growing mechanism
+
+    def grow(self, leaves: int=GROWTH_BATCH) -> int:
+        """Grows the tree by generating the children of up to `leaves` leaves, as many as fit in the budget. Returns the number of leaves expanded."""
+        with self.lock:
+            if self.max_nodes is not None:
+                if len(self.pool) + self.max_children > self.max_nodes:
+                    self.evict()
+                leaves = min(leaves, (self.max_nodes - len(self.pool)) // self.max_children)
+                if leaves == 0:
+                    self.full = True # nothing left to evict
+                    return 0
+            nodes = self._next_leaves(leaves)
+            if nodes.size == 0:
+                return 0
+            self._expand(nodes)
+            self._advance()
+            return len(nodes)
 
-    def grow(self):
-        """Grows the tree by generating the children of a single leaf."""
-        child = self.leaves[0]
-        self.leaves = np.append(np.delete(self.leaves, 0), child.get_children())
+    def _next_leaves(self, count: int) -> np.ndarray:
+        """Return the first `count` leaves in pool order, scanning no further past `self.frontier` than needed."""
+        n, window = len(self.pool), count
+        while True:
+            end = min(self.frontier + window, n)
+            leaves = self.frontier + np.flatnonzero(self.pool.first_children[self.frontier:end] < 0)
+            if len(leaves) >= count or end == n:
+                return leaves[:count]
+            window *= 4
+
+    def _advance(self):
+        """Move `self.frontier` forward to the first leaf."""
+        leaves = self._next_leaves(1)
+        self.frontier = int(leaves[0]) if leaves.size > 0 else len(self.pool)
+
+    def _rebuild(self):
+        """Index the boards of a new pool and find its first leaf."""
+        self.index = BoardIndex.from_pool(self.pool)
+        self.frontier = self.root
+        self._advance()
+
+    def _expand(self, nodes: np.ndarray):
+        children = self.pool.expand(nodes, self.chance_nodes)
+        self.index.insert(self.pool.boards[children], children)
 
 class Heuristics(object):
     """Defines different heuristic evaluation functions for game states."""
@@ -89,19 +294,25 @@ class Heuristics(object):
 
 class TreeSearchAI(BaseAI):
 
-    def __init__(self, game: GameState):
+    MAX_BYTES = 64 << 20 # default memory budget of the tree, which otherwise grows by hundreds of MB per second
+
+    def __init__(self, game: GameState, max_nodes: int=None, max_bytes: int=MAX_BYTES):
+        """`max_nodes` and `max_bytes` bound the size of the tree as in `GameTree`."""
         BaseAI.__init__(self, game)
-        self.tree = GameTree(game)
+        self.tree = GameTree(game, chance_nodes=True, max_nodes=max_nodes, max_bytes=max_bytes)
 
-    def make_move(self, move: Move=None):
+    def make_move(self, move: Move=None) -> Move:
         move = BaseAI.make_move(self, move)
-        # TODO update root and tree
+        self.tree.update(move, self.game_state)
+        return move
 
-    def evaluate_move(self, move: Move) -> int:
-        move_filter = np.vectorize(lambda x: np.array_equal(x.move_history[:self.tree.root.move_history.size+1], np.append(self.tree.root.move_history, move)))
-        leaves = self.tree.get_leaves()[move_filter(self.tree.get_leaves())]
-        # TODO get max value of `leaves`
-        pass
+    def evaluate_move(self, move: Move) -> float:
+        """Return the best heuristic value among the leaves reached by `move`, or 0 if the tree has none yet."""
+        with self.tree.lock:
+            leaves = self.tree.get_leaves()
+            leaves = leaves[self.tree.get_first_moves(leaves) == move.value]
+            values = heuristics.evaluate_array(self.tree.pool.boards[leaves])
+        return float(values.max(initial=0))
 
     def __str__(self) -> str:
         return "Tree Search"
@@ -109,13 +320,13 @@ class TreeSearchAI(BaseAI):
 if __name__ == '__main__':
     t = GameTree(GameState(4))
 
-    TIME_FREQ = 10 # number of times to check depth per second
-    depth = 5
+    TIME_FREQ = 1000 # number of times to check depth per second
+    depth = 7
     
     start = time.time_ns()
     while t.get_depth() < depth+1: 
         time.sleep(1/TIME_FREQ)
     end = time.time_ns()
 
-    leaves, depth, time, rate = t.get_leaves().size, t.get_depth()-1, int((end-start) * 10 ** -9 * TIME_FREQ)/TIME_FREQ, 0
-    print(f'DONE: Generated a tree of depth {depth} with {leaves} leaves in ~{time} seconds @ {round(leaves/time,2)} leaves/sec.')
\ No newline at end of file
+    leaves, depth, elapsed, rate = len(t.get_leaves()), t.get_depth()-1, int((end-start) * 10 ** -9 * TIME_FREQ)/TIME_FREQ, 0
+    print(f'DONE: Generated a tree of depth {depth} with {leaves} leaves in ~{elapsed} seconds @ {round(leaves/elapsed,2)} leaves/sec.')
\ No newline at end of file